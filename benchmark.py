@@ -0,0 +1,381 @@
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+from generate_protocols import DocumentGenerator
+from protocol_methods import filter_string, sanitize_columns
+from drive_api_sync import SyncPipeline
+from storage_backend import MemoryBackend
+
+WATERMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), '2023_04_QEC.png')
+
+# modules whose cold import is timed; exambot is what every scheduled run starts with
+IMPORT_MODULES = ['exambot', 'storage_backend', 'drive_api_sync', 'generate_protocols']
+
+WORDS = ['exam', 'oral', 'question', 'derivation', 'professor', 'asked', 'about', 'the', 'transfer', 'function',
+         'stability', 'eigenvalue', 'circuit', 'signal', 'quantum', 'field', 'energy', 'friendly', 'grade',
+         'Fourier', 'Laplace', 'proof', 'example', 'diagram', 'explain', 'why', 'and', 'then', 'what', 'happens']
+MATH = [r'$x_1^2 + y_2$', r'$\int_0^\infty e^{-x} dx$', r'$$\sum_{n=0}^{N} a_n$$', r'\(H(s) = \frac{1}{s+1}\)',
+        r'$\nabla \cdot E = \rho / \epsilon_0$']
+
+
+def random_text(rng, words, math_ratio=0.0):
+    """
+    Random summary text
+
+    Parameters
+    ----------
+    rng : random.Random
+        Random number generator.
+    words : int
+        Number of words.
+    math_ratio : float
+        Probability of inserting a math segment after a word.
+
+    Returns
+    -------
+    text : str
+        Random text.
+    """
+    parts = []
+    for _ in range(words):
+        parts.append(rng.choice(WORDS))
+        if rng.random() < math_ratio:
+            parts.append(rng.choice(MATH))
+    return ' '.join(parts) + '.'
+
+
+def make_synthetic_workbook(file_path, departments=3, subjects=20, semesters=6, entries=1000, math_ratio=0.2,
+                            long_ratio=0.1, seed=0):
+    """
+    Writes a synthetic protocols spreadsheet with the layout of Sheet2
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the XLSX file.
+    departments : int
+        Number of departments; the first three are itet, phys and other.
+    subjects : int
+        Number of subjects per department.
+    semesters : int
+        Number of semesters, counted back from the current one.
+    entries : int
+        Number of responses.
+    math_ratio : float
+        Share of responses whose summary contains LaTeX math.
+    long_ratio : float
+        Share of responses with a long summary.
+    seed : int
+        Seed of the random number generator.
+
+    Returns
+    -------
+    depts : list
+        Names of the departments.
+    """
+    rng = random.Random(seed)
+    depts = (['itet', 'phys', 'other'] + [f'dept{i}' for i in range(3, departments)])[:departments]
+    year = datetime.now().year
+    semester_names = [f"{'Fall' if i % 2 == 0 else 'Spring'} {year - (i + 1) // 2}" for i in range(semesters)]
+
+    rows = []
+    for i in range(entries):
+        dept = rng.choice(depts)
+        row = {'Timestamp': f'{year}-01-01 00:00:{i % 60:02d}', 'Email': f'student{i}@example.com'}
+        row.update({f'Subject_{d}': None for d in depts})
+        row[f'Subject_{dept}'] = f'{dept.upper()} Subject {rng.randrange(subjects)}'
+        row['Semester'] = rng.choice(semester_names)
+        row['Examiner'] = f'Prof. {rng.choice("ABCDEFGH")}'
+        words = rng.randint(300, 1200) if rng.random() < long_ratio else rng.randint(20, 120)
+        row['Summary'] = random_text(rng, words, 0.05 if rng.random() < math_ratio else 0.0)
+        row['Atmosphere'] = random_text(rng, rng.randint(5, 30)) if rng.random() < 0.7 else None
+        rows.append(row)
+    pd.DataFrame(rows).to_excel(file_path, sheet_name='Sheet2', index=False, engine='openpyxl')
+    return depts
+
+
+def time_stage(function, repeat=1):
+    """
+    Runs a function several times and measures its wall time
+
+    Parameters
+    ----------
+    function : callable
+        Function without arguments.
+    repeat : int
+        Number of runs.
+
+    Returns
+    -------
+    timing : dict
+        Minimum and mean wall time in seconds and the number of runs.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {'min': min(durations), 'mean': sum(durations) / len(durations), 'runs': repeat}
+
+
+def import_time(module, repeat=1, top=5):
+    """
+    Measures the cold import of a module in a fresh interpreter with python -X importtime
+
+    Parameters
+    ----------
+    module : str
+        Name of the module, imported from the folder of this script.
+    repeat : int
+        Number of runs.
+    top : int
+        Number of packages listed with their share of the import time.
+
+    Returns
+    -------
+    timing : dict
+        Minimum and mean import time in seconds, the number of runs and the packages that took the longest to
+        import in the fastest run, as pairs of package name and seconds.
+    """
+    durations = []
+    packages = None
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True,
+                                 text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        # lines look like 'import time:  self [us] | cumulative | imported package', the module itself comes last
+        times = {}
+        cumulative = 0
+        for line in process.stderr.splitlines():
+            fields = line.split('|')
+            if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name = fields[2].strip()
+            package = name.split('.')[0]
+            times[package] = times.get(package, 0) + int(fields[0].split(':')[1]) / 1e6
+            if name == module:
+                cumulative = int(fields[1]) / 1e6
+        if not durations or cumulative < min(durations):
+            packages = sorted(times.items(), key=lambda item: item[1], reverse=True)[:top]
+        durations.append(cumulative)
+    return {'min': min(durations), 'mean': sum(durations) / len(durations), 'runs': repeat, 'packages': packages}
+
+
+def git_commit():
+    """
+    Current git commit of the repository, or None outside of a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    """
+    Times every stage of the protocol generation on a synthetic spreadsheet
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed command line arguments, see main.
+
+    Returns
+    -------
+    results : dict
+        Configuration, environment and the timing of every stage.
+    """
+    logger = logging.getLogger('benchmark')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    stages = {}
+    for module in IMPORT_MODULES:
+        stages[f'import_{module}'] = import_time(module, args.repeat)
+
+    work_dir = tempfile.mkdtemp(prefix='exambot_benchmark_')
+    try:
+        filename = 'protocols.xlsx'
+        depts = make_synthetic_workbook(os.path.join(work_dir, filename), departments=args.departments,
+                                        subjects=args.subjects, semesters=args.semesters, entries=args.entries,
+                                        math_ratio=args.math_ratio, long_ratio=args.long_ratio, seed=args.seed)
+        os.mkdir(os.path.join(work_dir, 'Protocol_PDF'))
+        os.mkdir(os.path.join(work_dir, 'Protocol_Latex'))
+
+        def load(use_snapshot):
+            if not use_snapshot:
+                shutil.rmtree(os.path.join(work_dir, '.cache'), ignore_errors=True)
+            generator = DocumentGenerator(logger, work_dir, filename, 'Protocol_PDF', 'Protocol_Latex')
+            generator.watermark = WATERMARK
+            return generator
+
+        stages['excel_load'] = time_stage(lambda: load(False), args.repeat)
+        stages['snapshot_load'] = time_stage(lambda: load(True), args.repeat)
+
+        pdf_gen = load(True)
+        pdf_gen.valid_dept = depts
+        data = pdf_gen.full_df
+        stages['get_valid_subjects'] = time_stage(lambda: pdf_gen.get_valid_subjects(data), args.repeat)
+        stages['filter_string'] = time_stage(
+            lambda: [filter_string(text) for column in ['Summary', 'Atmosphere'] for text in data[column]],
+            args.repeat)
+        stages['sanitize_columns'] = time_stage(lambda: sanitize_columns(data), args.repeat)
+        sanitized = pd.concat([data, sanitize_columns(data)], axis=1, copy=False)
+        stages['group_subjects'] = time_stage(lambda: pdf_gen.group_subjects(sanitized), args.repeat)
+
+        # size of the loaded responses and the peak memory allocated while grouping them by subject
+        tracemalloc.start()
+        subject_groups = pdf_gen.group_subjects(sanitized)
+        memory = {'responses_bytes': int(data.memory_usage(deep=True).sum()),
+                  'group_peak_bytes': tracemalloc.get_traced_memory()[1]}
+        tracemalloc.stop()
+
+        for backend in ['pylatex', 'stream']:
+            def build_tex():
+                pdf_gen.backend = backend
+                for (_, subject), semester_groups in subject_groups.items():
+                    pdf_gen.write_tex(subject, semester_groups, os.path.join(pdf_gen.folder_path_tex,
+                                                                             f'{subject}.tex'))
+            stages[f'tex_build_{backend}'] = time_stage(build_tex, args.repeat)
+
+        compiler = shutil.which('pdflatex')
+        if compiler is not None and args.compile > 0:
+            subjects = list(subject_groups.items())[:args.compile]
+            pdf_gen.tex_format = None
+            stages['compile'] = time_stage(
+                lambda: [pdf_gen.make_subject_tex(subject, groups) for (_, subject), groups in subjects], 1)
+            pdf_gen.remove_build_dirs()
+            stages['compile']['subjects'] = len(subjects)
+        else:
+            stages['compile'] = {'skipped': 'pdflatex not found' if compiler is None else 'disabled'}
+
+        # upload synthetic PDFs, or the compiled ones, to an in-memory drive
+        pdf_folder = pdf_gen.folder_path_pdf
+        if not os.listdir(pdf_folder):
+            rng = random.Random(args.seed)
+            for i in range(len(subject_groups)):
+                with open(os.path.join(pdf_folder, f'20000101_Subject {i}.pdf'), 'wb') as pdf_file:
+                    pdf_file.write(b'%PDF-1.5\n' + rng.randbytes(args.pdf_size))
+
+        def memory_backend():
+            return MemoryBackend(logger, latency=args.latency / 1000, quota_error_rate=args.quota_error_rate,
+                                 seed=args.seed)
+
+        def upload():
+            storage = memory_backend()
+            pipeline = SyncPipeline(logger, storage, pdf_folder, storage.find_folder('Protocol_PDF'),
+                                    workers=args.upload_workers)
+            return pipeline.finish()
+        stages['upload'] = time_stage(upload, args.repeat)
+
+        def end_to_end():
+            # a nightly run on a new spreadsheet: no snapshot and no manifest, but the preamble format is cached
+            for snapshot in glob.glob(os.path.join(work_dir, '.cache', 'protocols_*')):
+                os.remove(snapshot)
+            for folder in [pdf_gen.folder_path_pdf, pdf_gen.folder_path_tex]:
+                shutil.rmtree(folder)
+                os.mkdir(folder)
+            storage = memory_backend()
+            generator = DocumentGenerator(logger, work_dir, filename, 'Protocol_PDF', 'Protocol_Latex',
+                                          backend='stream')
+            generator.valid_dept = depts
+            generator.watermark = WATERMARK
+            pipeline = SyncPipeline(logger, storage, generator.folder_path_pdf, storage.find_folder('Protocol_PDF'),
+                                    workers=args.upload_workers)
+            generator.generate_all_protocols(workers=args.workers, force=True, on_protocol=pipeline.submit)
+            pipeline.finish()
+        if compiler is not None and args.compile > 0:
+            stages['end_to_end'] = time_stage(end_to_end, 1)
+        else:
+            stages['end_to_end'] = {'skipped': 'pdflatex not found' if compiler is None else 'disabled'}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'commit': git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': vars(args),
+            'subjects': len(subject_groups),
+            'memory': memory,
+            'stages': stages}
+
+
+def compare(results, baseline):
+    """
+    Prints the change of every stage compared to an earlier result file
+
+    Parameters
+    ----------
+    results : dict
+        Results of this run, see run_benchmark.
+    baseline : dict
+        Results of an earlier run.
+    """
+    print(f"Compared to {baseline.get('commit')} ({baseline.get('date')}):")
+    for stage, timing in results['stages'].items():
+        old = baseline.get('stages', {}).get(stage, {})
+        if 'min' in timing and 'min' in old and old['min'] > 0:
+            print(f"  {stage:<26} {old['min']:9.4f} s -> {timing['min']:9.4f} s ({timing['min'] / old['min']:6.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the protocol generation on a synthetic spreadsheet.')
+    parser.add_argument('--departments', type=int, default=3)
+    parser.add_argument('--subjects', type=int, default=20, help='subjects per department')
+    parser.add_argument('--semesters', type=int, default=6)
+    parser.add_argument('--entries', type=int, default=1000)
+    parser.add_argument('--math-ratio', type=float, default=0.2)
+    parser.add_argument('--long-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage')
+    parser.add_argument('--compile', type=int, default=5, help='number of subjects compiled with pdflatex')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=20.0, help='latency of the in-memory drive in ms')
+    parser.add_argument('--quota-error-rate', type=float, default=0.0,
+                        help='share of in-memory drive requests failing with a quota error')
+    parser.add_argument('--pdf-size', type=int, default=100000, help='bytes per synthetic PDF')
+    parser.add_argument('--output', default='benchmark_results', help='folder for the JSON result files')
+    parser.add_argument('--compare', help='earlier JSON result file to compare with')
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    if not os.path.isdir(args.output):
+        os.mkdir(args.output)
+    output_file = os.path.join(args.output, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{results['commit']}.json")
+    with open(output_file, 'w', encoding='utf-8') as result_file:
+        json.dump(results, result_file, indent=2)
+
+    for stage, timing in results['stages'].items():
+        if 'min' in timing:
+            print(f"{stage:<26} min {timing['min']:9.4f} s  mean {timing['mean']:9.4f} s")
+            if timing.get('packages'):
+                print(' ' * 27 + ', '.join(f'{package} {seconds:.3f} s' for package, seconds in timing['packages']))
+        else:
+            print(f"{stage:<26} skipped: {timing['skipped']}")
+    print(f"Responses {results['memory']['responses_bytes'] / 1e6:.1f} MB, peak while grouping "
+          f"{results['memory']['group_peak_bytes'] / 1e6:.1f} MB")
+    print(f'Results written to {output_file}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import os
+import json
+import hashlib
+
+from protocol_methods import create_tex_preamble
+
+# bump whenever the layout of the generated protocols or of the manifest changes, so all subjects are rebuilt once
+MANIFEST_VERSION = 2
+
+# columns that end up in a protocol; a change in any of them requires a rebuild
+HASH_COLUMNS = ['Semester', 'Examiner', 'Summary', 'Atmosphere']
+
+
+def template_hash():
+    """
+    Hash of the LaTeX template used for all protocols
+
+    Returns
+    -------
+    template_hash : str
+        SHA-256 hex digest of the preamble created by create_tex_preamble.
+    """
+    preamble = create_tex_preamble().dumps()
+    return hashlib.sha256(f'{MANIFEST_VERSION}\n{preamble}'.encode('utf-8')).hexdigest()
+
+
+def subject_hash(dept, subject, semester_groups):
+    """
+    Hash of all rows that make up the protocol of one subject
+
+    Parameters
+    ----------
+    dept : str
+        Department name.
+    subject : str
+        Subject name.
+    semester_groups : list
+        (semester, semester_df) pairs with the responses of the subject, see DocumentGenerator.group_subjects.
+
+    Returns
+    -------
+    subject_hash : str
+        SHA-256 hex digest of the department, subject and its rows.
+    """
+    content_hash = hashlib.sha256(f'{dept}\n{subject}\n'.encode('utf-8'))
+    for _, semester_df in semester_groups:
+        content_hash.update(semester_df[HASH_COLUMNS].to_csv(index=False).encode('utf-8'))
+    return content_hash.hexdigest()
+
+
+class BuildManifest:
+    """
+    Persistent record of the content hash and output file of every generated protocol, keyed by department and
+    subject, since departments can have subjects of the same name
+    """
+    def __init__(self, logger, manifest_path):
+        """
+        Load the manifest from disk; a missing, unreadable or outdated manifest starts empty
+
+        Parameters
+        ----------
+        logger : logger object
+            logger object from the logging module.
+        manifest_path : str
+            Path to the JSON file storing the manifest.
+        """
+        self.logger = logger
+        self.manifest_path = manifest_path
+        self.template = template_hash()
+        self.subjects = {}
+
+        if os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+                    data = json.load(manifest_file)
+            except (OSError, ValueError) as e:
+                self.logger.error(f'Could not read build manifest {manifest_path}. Reason: {e}')
+                data = {}
+            if data.get('template') == self.template:
+                self.subjects = data.get('subjects', {})
+            elif data:
+                self.logger.info('Protocol template changed, all subjects will be rebuilt.')
+
+    def keys(self):
+        """
+        Department and subject of every recorded protocol
+
+        Returns
+        -------
+        keys : list
+            (department, subject) pairs.
+        """
+        return [(dept, subject) for dept, subjects in self.subjects.items() for subject in subjects]
+
+    def is_current(self, dept, subject, content_hash, folder_path_pdf, name=None):
+        """
+        Check whether the stored protocol of a subject is up to date
+
+        Parameters
+        ----------
+        dept : str
+            Department name.
+        subject : str
+            Subject name.
+        content_hash : str
+            Current hash of the subject, see subject_hash.
+        folder_path_pdf : str
+            Path to the local folder containing the PDF protocols.
+        name : str, optional
+            Name the protocol is expected to be filed under, see DocumentGenerator.protocol_names; defaults to the
+            subject name.
+
+        Returns
+        -------
+        current : bool
+            True, if the hash is unchanged, the protocol is filed under name and the PDF still exists.
+        """
+        entry = self.subjects.get(dept, {}).get(subject)
+        if entry is None or entry['hash'] != content_hash:
+            return False
+        # the name changes when another department adds or drops a subject of the same name; the protocol is
+        # then rebuilt under the new name and the old file removed
+        if entry['basename'].partition('_')[2] != (subject if name is None else name):
+            return False
+        return os.path.isfile(os.path.join(folder_path_pdf, f"{entry['basename']}.pdf"))
+
+    def update(self, dept, subject, content_hash, basename):
+        """
+        Record a freshly generated protocol
+
+        Parameters
+        ----------
+        dept : str
+            Department name.
+        subject : str
+            Subject name.
+        content_hash : str
+            Hash of the subject the protocol was generated from.
+        basename : str
+            Filename of the generated tex and PDF files without extension.
+
+        Returns
+        -------
+        old_basename : str or None
+            Filename of the previous protocol of this subject, if it differs from the new one.
+        """
+        old_entry = self.subjects.get(dept, {}).get(subject)
+        self.subjects.setdefault(dept, {})[subject] = {'hash': content_hash, 'basename': basename}
+        if old_entry is not None and old_entry['basename'] != basename:
+            return old_entry['basename']
+        return None
+
+    def remove(self, dept, subject):
+        """
+        Forget a subject
+
+        Parameters
+        ----------
+        dept : str
+            Department name.
+        subject : str
+            Subject name.
+
+        Returns
+        -------
+        basename : str or None
+            Filename of the protocol of this subject, if there was one.
+        """
+        entry = self.subjects.get(dept, {}).pop(subject, None)
+        if not self.subjects.get(dept, True):
+            del self.subjects[dept]
+        return None if entry is None else entry['basename']
+
+    def save(self):
+        """
+        Write the manifest to disk; the file is replaced atomically so an aborted run never corrupts it
+        """
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'template': self.template, 'subjects': self.subjects}, manifest_file, indent=2)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,155 @@
+from __future__ import print_function
+
+import time
+import logging
+import threading
+
+from drive_api_session import get_drive_session
+from drive_api_folder import PAGE_SIZE
+from drive_api_retry import get_request_executor
+from metrics import get_metrics
+
+
+def get_start_page_token(logger, token_path):
+    """
+    Token of the current position of the drive changes feed; changes made after it are returned by list_changes
+
+    Parameters
+    ----------
+    logger : logger object
+        logger object from the logging module.
+    token_path : str
+        Path to the folder containing the token.json file.
+
+    Returns
+    -------
+    page_token : str
+        Start page token of the changes feed.
+    """
+    service = get_drive_session(token_path).service
+    # pylint: disable=maybe-no-member
+    response = get_request_executor().execute(service.changes().getStartPageToken(supportsAllDrives=True).execute)
+    get_metrics().count(api_calls=1)
+    return response['startPageToken']
+
+
+def list_changes(logger, token_path, page_token):
+    """
+    Lists the files that changed since page_token, following all pages of the changes feed
+
+    Parameters
+    ----------
+    logger : logger object
+        logger object from the logging module.
+    token_path : str
+        Path to the folder containing the token.json file.
+    page_token : str
+        Token returned by get_start_page_token or by an earlier call.
+
+    Returns
+    -------
+    file_ids : list
+        IDs of the changed files, in the order of the changes; a file changed several times is listed several times.
+    page_token : str
+        Token to continue from in the next call.
+    """
+    service = get_drive_session(token_path).service
+    executor = get_request_executor()
+    file_ids = []
+    while True:
+        # pylint: disable=maybe-no-member
+        response = executor.execute(service.changes().list(pageToken=page_token, pageSize=PAGE_SIZE, spaces='drive',
+                                                           includeItemsFromAllDrives=True, supportsAllDrives=True,
+                                                           fields='nextPageToken, newStartPageToken, '
+                                                                  'changes(fileId)').execute)
+        get_metrics().count(api_calls=1)
+        file_ids.extend(change['fileId'] for change in response.get('changes', []))
+        if 'newStartPageToken' in response:
+            return file_ids, response['newStartPageToken']
+        page_token = response['nextPageToken']
+
+
+class ChangeWatcher:
+    """
+    Follows the changes feed of a storage and waits for changes of one file, e.g. the protocols spreadsheet. A
+    burst of edits is debounced: wait returns once the file did not change for debounce seconds, or max_delay
+    seconds after the first change of the burst if the edits do not stop.
+    """
+    def __init__(self, logger, storage, file_id, poll_interval=30.0, debounce=120.0, max_delay=900.0):
+        """
+        Initialize ChangeWatcher class; changes are reported from this moment on
+
+        Parameters
+        ----------
+        logger : logger object
+            logger object from the logging module.
+        storage : StorageBackend
+            Storage whose changes feed is followed, see storage_backend.
+        file_id : str
+            ID of the watched file.
+        poll_interval : float
+            Seconds between two requests to the changes feed.
+        debounce : float
+            Seconds without a change of the file after which a burst of edits is considered finished.
+        max_delay : float
+            Upper bound of the seconds between the first change of a burst and the end of wait.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.storage = storage
+        self.file_id = file_id
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.stopped = threading.Event()
+        self.page_token = storage.start_page_token()
+
+    def poll(self):
+        """
+        Reads the new entries of the changes feed
+
+        Returns
+        -------
+        changes : int
+            Number of changes of the watched file since the last poll; 0 if the feed could not be read.
+        """
+        # a watcher runs for days; connection, token refresh and API errors that outlast the retries of the
+        # request executor must not end it, the feed is read again at the next poll
+        try:
+            file_ids, self.page_token = self.storage.changes(self.page_token)
+        except Exception as error:
+            self.logger.error(F'An error occurred: {error}')
+            return 0
+        return file_ids.count(self.file_id)
+
+    def wait(self):
+        """
+        Blocks until the watched file changed and the burst of edits is over, or until stop is called
+
+        Returns
+        -------
+        changed : bool
+            True, if the file changed; False, if the watcher was stopped.
+        """
+        first_change = last_change = None
+        changes = 0
+        while not self.stopped.is_set():
+            new_changes = self.poll()
+            now = time.monotonic()
+            if new_changes:
+                if first_change is None:
+                    self.logger.info(f'Change of {self.file_id} detected, waiting for further edits.')
+                    first_change = now
+                last_change = now
+                changes += new_changes
+            if first_change is not None and (now - last_change >= self.debounce
+                                             or now - first_change >= self.max_delay):
+                self.logger.info(f'{changes} changes of {self.file_id} within {now - first_change:.1f} s.')
+                return True
+            self.stopped.wait(self.poll_interval)
+        return False
+
+    def stop(self):
+        """
+        Ends a running or the next call of wait
+        """
+        self.stopped.set()
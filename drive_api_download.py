@@ -1,48 +1,102 @@
 from __future__ import print_function
 
-import io
 import os
+import json
 import logging
 from datetime import datetime
 
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload
+from storage_backend import DriveBackend
+from metrics import get_metrics
 
 
-def export_excel(logger, path, filename, real_file_id):
-    """Download a Document file in PDF format.
+def load_spreadsheet_state(path):
+    """
+    Loads the state of the last downloaded spreadsheet snapshot
 
-    :param real_file_id: ile ID of any workspace document format file
-    :param filename:
-    :param path:
-    Returns : IO object with location
+    :param path: folder containing spreadsheet_state.json
+    Returns : dict with file_id, modifiedTime, version, filename and processed; empty if there is none
     """
+    try:
+        with open(os.path.join(path, 'spreadsheet_state.json'), 'r', encoding='utf-8') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
 
-    SCOPES = ['https://www.googleapis.com/auth/drive']
 
-    creds = Credentials.from_authorized_user_file(os.path.join(path, 'token.json'), SCOPES)
+def save_spreadsheet_state(path, state):
+    """
+    Stores the state of the downloaded spreadsheet snapshot; the file is replaced atomically
+
+    :param path: folder containing spreadsheet_state.json
+    :param state: dict with file_id, modifiedTime, version, filename and processed
+    """
+    state_path = os.path.join(path, 'spreadsheet_state.json')
+    with open(f'{state_path}.tmp', 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(f'{state_path}.tmp', state_path)
+
+
+def mark_spreadsheet_processed(path):
+    """
+    Records that all protocols of the cached spreadsheet snapshot were generated and uploaded
+
+    :param path: folder containing spreadsheet_state.json
+    """
+    state = load_spreadsheet_state(path)
+    if state:
+        state['processed'] = True
+        save_spreadsheet_state(path, state)
+
+
+def export_excel(logger, path, filename, real_file_id, storage=None):
+    """Download the protocols spreadsheet in XLSX format, unless the cached snapshot is still current.
+
+    The modifiedTime and version of the sheet are compared with the cached snapshot first. A new export is
+    streamed directly into a temporary file next to the target and moved in place once it is complete.
+
+    :param logger: logger object from the logging module
+    :param path: folder where the spreadsheet and its state are stored
+    :param filename: name under which a new export is saved
+    :param real_file_id: file ID of the spreadsheet in drive
+    :param storage: StorageBackend the spreadsheet is exported from, Google Drive by default
+    Returns : (filename, changed) with the name of the spreadsheet to use, or None if there is none, and
+        False only if the snapshot is unchanged and was already processed completely
+    """
+    state = load_spreadsheet_state(path)
+    cached = state.get('filename')
+    if cached is not None and not os.path.isfile(os.path.join(path, cached)):
+        cached = None
+
+    if storage is None:
+        storage = DriveBackend(logger, path)
 
     try:
-        # create drive api client
-        service = build('drive', 'v3', credentials=creds)
         file_id = real_file_id
+        metadata = storage.metadata(file_id)
+        if (cached is not None and state.get('file_id') == file_id
+                and state.get('modifiedTime') == metadata.get('modifiedTime')
+                and state.get('version') == metadata.get('version')):
+            logger.info(f'Spreadsheet unchanged since {metadata.get("modifiedTime")}, using {cached}.')
+            return cached, not state.get('processed', False)
+
+        tmp_path = os.path.join(path, f'{filename}.part')
+        storage.export(file_id, tmp_path)
+        get_metrics().count(bytes=os.path.getsize(tmp_path))
+        os.replace(tmp_path, os.path.join(path, filename))
 
-        # pylint: disable=maybe-no-member
-        request = service.files().export_media(fileId=file_id,
-                                               mimeType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        file = io.BytesIO()
-        downloader = MediaIoBaseDownload(file, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            logger.info(F'Download {int(status.progress() * 100)}.')
-
-    except HttpError as error:
+    except (HttpError, OSError) as error:
         logger.error(F'An error occurred: {error}')
-        file = None
+        if os.path.isfile(os.path.join(path, f'{filename}.part')):
+            os.remove(os.path.join(path, f'{filename}.part'))
+        if cached is not None:
+            logger.info(f'Falling back to cached spreadsheet {cached}.')
+        return cached, True
 
-    with open(os.path.join(path, filename), 'wb') as output_file:
-        output_file.write(file.getvalue())
+    save_spreadsheet_state(path, {'file_id': file_id,
+                                  'modifiedTime': metadata.get('modifiedTime'),
+                                  'version': metadata.get('version'),
+                                  'filename': filename,
+                                  'processed': False})
     logger.info(f'{filename} downloaded at {path}')
+    return filename, True
@@ -1,11 +1,21 @@
 from __future__ import print_function
 
 import os
+import json
 import logging
 
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from drive_api_session import get_drive_session
+from drive_api_retry import get_request_executor, classify_error
+from metrics import get_metrics
+
+# maximum number of calls the Drive API accepts in one batch request
+BATCH_SIZE = 100
+
+# maximum number of files files().list returns per page
+PAGE_SIZE = 1000
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
 
 
 def get_folder(logger, path, folder_name, parent_folder_id=None):
@@ -29,21 +39,18 @@ def get_folder(logger, path, folder_name, parent_folder_id=None):
     folder_id : str
         ID of the folder in drive with the desired foldername
     """
-    SCOPES = ['https://www.googleapis.com/auth/drive']
-
-    creds = Credentials.from_authorized_user_file(os.path.join(path, 'token.json'), SCOPES)
-
-    service = build('drive', 'v3', credentials=creds)
+    service = get_drive_session(path).service
 
     # List all folders in your Google Drive
-    query = f"mimeType='application/vnd.google-apps.folder' and name='{folder_name}'"
+    query = f"mimeType='{FOLDER_MIMETYPE}' and name='{folder_name}' and trashed = false"
     if parent_folder_id is not None:
         query += f" and '{parent_folder_id}' in parents"
-    results = service.files().list(
+    results = get_request_executor().execute(service.files().list(
         q=query,
         spaces='drive',
         fields='files(id, name)'
-    ).execute()
+    ).execute)
+    get_metrics().count(api_calls=1)
 
     for file in results.get("files", []):
         # Process change
@@ -57,6 +64,60 @@ def get_folder(logger, path, folder_name, parent_folder_id=None):
     return folder_id
 
 
+def resolve_folder(logger, path, folder_name, parent_folder_id=None):
+    """
+    Returns the ID of a folder like get_folder, but remembers it in folder_ids.json. A remembered ID is only
+    checked with a single files().get request; the folder is searched again if it was deleted, trashed, renamed
+    or moved.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+        Logger object
+    path : str
+        Path to the folder containing the token.json file.
+    folder_name : str
+        Name of the folder in shared Google Drive
+    parent_folder_id : str, optional
+        ID of the parent folder in drive with the desired foldername
+
+    Returns
+    -------
+    folder_id : list
+        ID of the folder in drive with the desired foldername, empty if there is none
+    """
+    cache_path = os.path.join(path, 'folder_ids.json')
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        cache = {}
+    key = f"{parent_folder_id or ''}/{folder_name}"
+
+    if key in cache:
+        service = get_drive_session(path).service
+        try:
+            folder = get_request_executor().execute(service.files().get(
+                fileId=cache[key], fields='name, mimeType, trashed, parents').execute)
+            get_metrics().count(api_calls=1)
+            if (folder.get('name') == folder_name and folder.get('mimeType') == FOLDER_MIMETYPE
+                    and not folder.get('trashed', False)
+                    and (parent_folder_id is None or parent_folder_id in folder.get('parents', []))):
+                return [cache[key]]
+        except HttpError as error:
+            if error.status_code != 404:
+                raise
+        logger.info(f'Remembered ID of folder {folder_name} is outdated, searching it again.')
+
+    folder_id = get_folder(logger, path, folder_name, parent_folder_id=parent_folder_id)
+    if folder_id:
+        cache[key] = folder_id[0]
+        with open(f'{cache_path}.tmp', 'w', encoding='utf-8') as cache_file:
+            json.dump(cache, cache_file, indent=2)
+        os.replace(f'{cache_path}.tmp', cache_path)
+    return folder_id
+
+
 def clean_data_drive(logger, token_path, folder_id):
     """
     Deletes all files in the folder with the given folder_id
@@ -70,25 +131,149 @@ def clean_data_drive(logger, token_path, folder_id):
     folder_id : str
         ID of the folder in drive with the desired foldername
     """
-    SCOPES = ['https://www.googleapis.com/auth/drive']
-    creds = Credentials.from_authorized_user_file(os.path.join(token_path, 'token.json'), SCOPES)
-
     try:
-        # create drive api client
-        service = build('drive', 'v3', credentials=creds)
-        # TODO make code better and more failsafe...
-        results = service.files().list(q=f"'{folder_id[0]}' in parents",
-                                       fields='nextPageToken, files(id, name)').execute()
-
-        files = results.get('files', [])
-        for file in files:
-            service.files().delete(fileId=file['id']).execute()
-            logger.info(f"Deleted {file['name']}.")
+        # list every page before deleting anything, so the deletions cannot shift the pages
+        files = list(iter_folder_files(logger, token_path, folder_id, fields='id, name'))
+        delete_files(logger, token_path, files)
 
     except HttpError as error:
         logger.error(F'An error occurred: {error}')
 
 
+def iter_folder_files(logger, token_path, folder_id, fields='id, name, md5Checksum'):
+    """
+    Yields the files in the folder with the given folder_id while following the result pages. Every page holds
+    up to PAGE_SIZE files and only the requested fields, so a listing costs one request per PAGE_SIZE files.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+        Logger object
+    token_path : str
+        Path to the folder containing the token.json file.
+    folder_id : list
+        ID of the folder in drive with the desired foldername, as returned by get_folder.
+    fields : str
+        File fields to request.
+
+    Yields
+    ------
+    file : dict
+        File in the folder with the requested fields.
+    """
+    service = get_drive_session(token_path).service
+    page_token = None
+    while True:
+        results = get_request_executor().execute(service.files().list(
+            q=f"'{folder_id[0]}' in parents and trashed = false",
+            fields=f'nextPageToken, files({fields})',
+            pageSize=PAGE_SIZE,
+            pageToken=page_token).execute)
+        get_metrics().count(api_calls=1)
+        yield from results.get('files', [])
+        page_token = results.get('nextPageToken')
+        if page_token is None:
+            break
+
+
+def list_folder_files(logger, token_path, folder_id, fields='id, name, md5Checksum'):
+    """
+    Lists all files in the folder with the given folder_id, following every result page
+
+    Parameters
+    ----------
+    logger : logging.Logger
+        Logger object
+    token_path : str
+        Path to the folder containing the token.json file.
+    folder_id : list
+        ID of the folder in drive with the desired foldername, as returned by get_folder.
+    fields : str
+        File fields to request.
+
+    Returns
+    -------
+    files : list
+        Files in the folder as dicts with the requested fields.
+    """
+    files = list(iter_folder_files(logger, token_path, folder_id, fields=fields))
+    logger.info(f'Listed {len(files)} remote files.')
+    return files
+
+
+def delete_files(logger, token_path, files, retries=3):
+    """
+    Deletes files using batch requests of up to BATCH_SIZE calls. Only the deletions that failed with a retryable
+    error are retried, see drive_api_retry.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+        Logger object
+    token_path : str
+        Path to the folder containing the token.json file.
+    files : list
+        Files to delete as dicts with the keys 'id' and 'name'.
+    retries : int
+        Number of times failed deletions are retried.
+
+    Returns
+    -------
+    failed : list
+        Files that could not be deleted.
+    """
+    service = get_drive_session(token_path).service
+    executor = get_request_executor()
+    pending = list(files)
+    given_up = []
+
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            logger.info(f'Retrying {len(pending)} failed deletions...')
+            executor.backoff(attempt)
+        failed = []
+
+        for start in range(0, len(pending), BATCH_SIZE):
+            chunk = {file['id']: file for file in pending[start:start + BATCH_SIZE]}
+            errors = {}
+            done = set()
+
+            def callback(request_id, response, exception):
+                done.add(request_id)
+                # a file that is already gone does not need to be deleted again
+                if exception is None or (isinstance(exception, HttpError) and exception.status_code == 404):
+                    logger.info(f"Deleted {chunk[request_id]['name']}.")
+                    return
+                logger.error(f"Could not delete {chunk[request_id]['name']}. Reason: {exception}")
+                category = classify_error(exception)
+                if category == 'fatal':
+                    given_up.append(chunk[request_id])
+                    return
+                if category == 'rate_limit':
+                    executor.rate_limited()
+                errors[request_id] = exception
+
+            batch = service.new_batch_http_request(callback=callback)
+            for file_id in chunk:
+                batch.add(service.files().delete(fileId=file_id), request_id=file_id)
+            try:
+                get_metrics().count(api_calls=1)
+                executor.execute(batch.execute)
+            except (HttpError, OSError) as error:
+                # the whole batch failed; retry every item of it that has no result yet
+                logger.error(F'An error occurred: {error}')
+                errors.update({file_id: error for file_id in chunk if file_id not in done})
+            failed.extend(chunk[file_id] for file_id in errors)
+
+        pending = failed
+        if not pending:
+            break
+
+    for file in given_up + pending:
+        logger.error(f"Giving up deleting {file['name']}.")
+    return given_up + pending
+
+
 def create_folder(logger, path):
     """ 
     Create a folder and prints the folder ID
@@ -105,12 +290,9 @@ def create_folder(logger, path):
     folder_id : str
         ID of the folder in drive with the desired foldername
     """
-    SCOPES = ['https://www.googleapis.com/auth/drive']
-    creds = Credentials.from_authorized_user_file(os.path.join(path, 'token.json'), SCOPES)
-
     try:
-        # create drive api client
-        service = build('drive', 'v3', credentials=creds)
+        # get shared drive api client
+        service = get_drive_session(path).service
         file_metadata = {
             'name': 'Invoices',
             'mimeType': 'application/vnd.google-apps.folder'
@@ -0,0 +1,227 @@
+from __future__ import print_function
+
+import json
+import time
+import random
+import logging
+import threading
+
+from metrics import get_metrics
+
+# HTTP status codes of transient server errors
+RETRYABLE_STATUS = (500, 502, 503, 504)
+
+# reasons of 403 responses that only mean the request came too early
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def error_reason(error):
+    """
+    Reason of a failed Drive API request, e.g. 'userRateLimitExceeded'
+
+    Parameters
+    ----------
+    error : HttpError
+        Error raised by the Drive API client.
+
+    Returns
+    -------
+    reason : str or None
+        Reason of the first error in the response body, None if the body has none.
+    """
+    try:
+        return json.loads(error.content.decode('utf-8'))['error']['errors'][0]['reason']
+    except (AttributeError, ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def classify_error(error):
+    """
+    Decides whether a failed request should be retried
+
+    Parameters
+    ----------
+    error : Exception
+        Error raised by the request.
+
+    Returns
+    -------
+    category : str
+        'rate_limit' for 429 and rate limit 403 responses, 'transient' for server and connection errors that are
+        worth retrying and 'fatal' for everything else.
+    """
+    # the client libraries are only needed once a request failed, so they are not imported with the module
+    from httplib2 import HttpLib2Error
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        if error.status_code == 429 or (error.status_code == 403 and error_reason(error) in RATE_LIMIT_REASONS):
+            return 'rate_limit'
+        if error.status_code in RETRYABLE_STATUS:
+            return 'transient'
+        return 'fatal'
+    if isinstance(error, (OSError, HttpLib2Error)):
+        return 'transient'
+    return 'fatal'
+
+
+class RequestExecutor:
+    """
+    Runs Drive API requests with retries and an adaptive limit on the number of requests in flight. Rate limit
+    and transient errors are retried with exponential backoff and full jitter. The limit grows by one request
+    per limit successful requests and is halved on a rate limit response (AIMD), so the requests settle just
+    below the quota of the drive. After a rate limit response, no new request is started for base_delay seconds.
+    """
+    def __init__(self, logger=None, max_concurrency=8, min_concurrency=1, retries=6, base_delay=1.0,
+                 max_delay=64.0):
+        """
+        Initialize RequestExecutor class
+
+        Parameters
+        ----------
+        logger : logger object, optional
+            logger object from the logging module.
+        max_concurrency : int
+            Upper bound and initial value of the number of requests in flight.
+        min_concurrency : int
+            Lower bound of the number of requests in flight.
+        retries : int
+            Number of times a failed request is retried before its error is raised.
+        base_delay : float
+            Seconds of the first backoff; every further retry doubles it.
+        max_delay : float
+            Upper bound of a single backoff in seconds.
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.hold_until = 0.0
+        self.pause_until = 0.0
+        self.condition = threading.Condition()
+        self.stats = {'requests': 0, 'retries': 0, 'rate_limited': 0, 'failed': 0}
+
+    def acquire(self):
+        """
+        Waits until fewer requests than the current limit are in flight and a pause after a rate limit is over
+        """
+        with self.condition:
+            while True:
+                pause = self.pause_until - time.monotonic()
+                if pause <= 0 and self.in_flight < max(self.min_concurrency, int(self.limit)):
+                    break
+                self.condition.wait(timeout=pause if pause > 0 else None)
+            self.in_flight += 1
+
+    def release(self, success):
+        """
+        Frees the slot of a finished request; a successful request raises the limit by 1 / limit
+
+        Parameters
+        ----------
+        success : bool
+            True, if the request succeeded.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.stats['requests'] += 1
+            if success:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def rate_limited(self):
+        """
+        Halves the limit and pauses new requests after a rate limit response; responses to requests that were
+        already in flight when the limit was last lowered do not lower it again
+        """
+        with self.condition:
+            self.stats['rate_limited'] += 1
+            now = time.monotonic()
+            if now >= self.hold_until:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self.hold_until = now + self.base_delay
+                self.pause_until = now + self.base_delay
+                self.logger.info(f'Drive rate limit reached, lowering the concurrency to {int(self.limit)}.')
+
+    def backoff(self, attempt):
+        """
+        Sleeps before a retry, for a random time up to base_delay * 2 ** attempt seconds
+
+        Parameters
+        ----------
+        attempt : int
+            Number of the retry, starting at 0.
+        """
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+    def execute(self, function, *args, **kwargs):
+        """
+        Calls function, which should make a single request, and retries it until it succeeds
+
+        Parameters
+        ----------
+        function : callable
+            Function making the request, e.g. the execute method of a Drive API request.
+        args, kwargs
+            Arguments passed to function.
+
+        Returns
+        -------
+        response
+            Return value of function.
+
+        Raises
+        ------
+        Exception
+            The error of the last attempt if it is fatal or all retries failed.
+        """
+        for attempt in range(self.retries + 1):
+            self.acquire()
+            try:
+                response = function(*args, **kwargs)
+            except Exception as error:
+                self.release(False)
+                category = classify_error(error)
+                if category == 'rate_limit':
+                    self.rate_limited()
+                if category == 'fatal' or attempt == self.retries:
+                    with self.condition:
+                        self.stats['failed'] += 1
+                    raise
+                self.logger.info(f'Request failed ({category}), retry {attempt + 1} of {self.retries}. '
+                                 f'Reason: {error}')
+                with self.condition:
+                    self.stats['retries'] += 1
+                get_metrics().count(retries=1)
+                self.backoff(attempt)
+            else:
+                self.release(True)
+                return response
+
+
+# executor shared by all drive requests of a run
+_executor = RequestExecutor()
+
+
+def get_request_executor():
+    """
+    Returns the executor all drive requests are made with
+    """
+    return _executor
+
+
+def set_request_executor(executor):
+    """
+    Installs the executor all drive requests are made with
+
+    Parameters
+    ----------
+    executor : RequestExecutor
+        Executor of the current run.
+    """
+    global _executor
+    _executor = executor
@@ -0,0 +1,90 @@
+from __future__ import print_function
+
+import os
+import threading
+
+# the google client libraries are imported by the methods that need them, importing them takes several hundred
+# milliseconds and offline runs never use them
+
+SCOPES = ['https://www.googleapis.com/auth/drive']
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class DriveSession:
+    """
+    Credentials and Drive API client shared by all drive_api_* functions during one run
+    """
+    def __init__(self, token_path):
+        """
+        Load the credentials from token.json
+
+        Parameters
+        ----------
+        token_path : str
+            Path to the folder containing the token.json file.
+        """
+        from google.oauth2.credentials import Credentials
+
+        self.token_file = os.path.join(token_path, 'token.json')
+        self.creds = Credentials.from_authorized_user_file(self.token_file, SCOPES)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def service(self):
+        """
+        Drive API client of the calling thread. The client is built once per thread from the discovery document
+        bundled with googleapiclient, so no network round trip is needed. Each thread gets its own client
+        because the underlying http object is not thread-safe.
+
+        Returns
+        -------
+        service : googleapiclient.discovery.Resource
+            Drive v3 API client.
+        """
+        from googleapiclient.discovery import build
+
+        self.refresh()
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = build('drive', 'v3', credentials=self.creds, static_discovery=True)
+            self._local.service = service
+        return service
+
+    def refresh(self):
+        """
+        Refresh the access token if it expired and store the new token in token.json
+        """
+        from google.auth.transport.requests import Request
+
+        with self._lock:
+            if self.creds.valid or not self.creds.refresh_token:
+                return
+            self.creds.refresh(Request())
+            with open(self.token_file, 'w') as token:
+                token.write(self.creds.to_json())
+
+
+def get_drive_session(token_path):
+    """
+    Returns the Drive session for the given token, creating it on first use
+
+    Parameters
+    ----------
+    token_path : str
+        Path to the folder containing the token.json file.
+
+    Returns
+    -------
+    session : DriveSession
+        Session shared by all callers using the same token.
+    """
+    with _sessions_lock:
+        session = _sessions.get(token_path)
+        if session is None:
+            session = DriveSession(token_path)
+            _sessions[token_path] = session
+        return session
+
@@ -0,0 +1,228 @@
+from __future__ import print_function
+
+import os
+import re
+import time
+import queue
+import hashlib
+import threading
+
+from metrics import get_metrics
+
+# protocols are named <YYYYMMDD>_<subject>.pdf; the date changes whenever a protocol is rebuilt
+DATE_PREFIX = re.compile(r'^\d{8}_')
+
+
+def protocol_key(filename):
+    """
+    Name of a protocol without its date prefix, used to match local and remote versions of the same protocol
+
+    Parameters
+    ----------
+    filename : str
+        Name of the protocol file.
+
+    Returns
+    -------
+    key : str
+        Filename without the leading date.
+    """
+    return DATE_PREFIX.sub('', filename)
+
+
+def md5_checksum(file_path, block_size=1024 * 1024):
+    """
+    MD5 checksum of a local file, comparable to the md5Checksum drive reports
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the file.
+    block_size : int
+        Number of bytes read at once.
+
+    Returns
+    -------
+    checksum : str
+        MD5 hex digest of the file content.
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class SyncPipeline:
+    """
+    Synchronises the local PDF folder with a drive folder while the protocols are still being generated. Every
+    submitted PDF is queued and synchronised by a pool of upload workers right away; finish waits for the queue,
+    synchronises the remaining local PDFs and only then deletes orphaned remote files.
+    """
+    def __init__(self, logger, storage, filepath, folder_id, workers=4, queue_size=None):
+        """
+        Lists the remote folder once and starts the upload workers
+
+        Parameters
+        ----------
+        logger : logging.Logger
+            Logger object
+        storage : StorageBackend
+            Storage the protocols are synchronised with, see storage_backend.
+        filepath : str
+            Path to the local folder containing the PDF protocols.
+        folder_id : list
+            ID of the folder in drive, as returned by find_folder.
+        workers : int
+            Maximum number of simultaneous uploads.
+        queue_size : int, optional
+            Number of PDFs that may wait for an upload worker before submit blocks; defaults to twice the workers.
+        """
+        self.logger = logger
+        self.storage = storage
+        self.filepath = filepath
+        self.folder_id = folder_id
+
+        self.remote = {}
+        self.orphans = []
+        for file in storage.list_folder(folder_id):
+            key = protocol_key(file['name'])
+            if key in self.remote:
+                self.orphans.append(file)
+            else:
+                self.remote[key] = file
+
+        self.summary = {'unchanged': [], 'renamed': [], 'updated': [], 'new': [], 'deleted': [], 'failed': [],
+                        'skipped': [], 'bytes': 0, 'seconds': 0.0}
+        self.submitted = set()
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.queue = queue.Queue(maxsize=queue_size or 2 * max(1, workers))
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, filename):
+        """
+        Queues a local PDF for synchronisation; blocks while the queue is full. Files that are not PDFs are skipped.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the file in the local folder.
+        """
+        with self.lock:
+            if filename in self.submitted or filename in self.summary['skipped']:
+                return
+            if not filename.lower().endswith('.pdf'):
+                self.summary['skipped'].append(filename)
+                return
+            self.submitted.add(filename)
+        self.queue.put(filename)
+
+    def worker(self):
+        """
+        Synchronises queued PDFs until it receives None
+        """
+        while True:
+            filename = self.queue.get()
+            try:
+                if filename is None:
+                    return
+                with get_metrics().span('upload', file=filename) as span:
+                    span['outcome'] = self.sync_file(filename)
+            except Exception as error:
+                self.logger.error(f'Synchronisation of {filename} failed. Reason: {error}')
+                with self.lock:
+                    self.summary['failed'].append(filename)
+            finally:
+                self.queue.task_done()
+
+    def sync_file(self, filename):
+        """
+        Uploads, updates or renames one PDF so that drive matches the local file
+
+        Parameters
+        ----------
+        filename : str
+            Name of the PDF in the local folder.
+
+        Returns
+        -------
+        outcome : str
+            'new', 'updated', 'renamed' or 'unchanged'.
+        """
+        file_path = os.path.join(self.filepath, filename)
+        remote_file = self.remote.get(protocol_key(filename))
+        if remote_file is None:
+            self.storage.upload(self.filepath, filename, self.folder_id)
+            outcome = 'new'
+        elif remote_file.get('md5Checksum') != md5_checksum(file_path):
+            self.storage.upload(self.filepath, filename, self.folder_id, file_id=remote_file['id'])
+            outcome = 'updated'
+        elif remote_file['name'] != filename:
+            # same content under a new date; only the metadata needs to change
+            self.storage.rename(remote_file['id'], filename)
+            outcome = 'renamed'
+        else:
+            outcome = 'unchanged'
+
+        with self.lock:
+            self.summary[outcome].append(filename)
+            if outcome in ['new', 'updated']:
+                self.summary['bytes'] += os.path.getsize(file_path)
+        if outcome != 'unchanged':
+            self.logger.info(f'Synchronised {filename} ({outcome}).')
+        return outcome
+
+    def finish(self, complete=True):
+        """
+        Synchronises all local PDFs that were not submitted yet, waits for the upload workers and then deletes
+        orphaned remote files
+
+        Parameters
+        ----------
+        complete : bool
+            If False, only the submitted PDFs are synchronised, e.g. after regenerating a few subjects. Remote
+            files of other protocols are left alone; only older duplicates of the submitted protocols are deleted.
+
+        Returns
+        -------
+        summary : dict
+            Names of the unchanged, renamed, updated, new, deleted, failed and skipped files, the number of
+            uploaded bytes and the elapsed seconds.
+        """
+        local_keys = set()
+        if complete:
+            for filename in sorted(os.listdir(self.filepath)):
+                if filename.lower().endswith('.pdf'):
+                    local_keys.add(protocol_key(filename))
+                self.submit(filename)
+
+        # barrier: every upload has to be done before anything is deleted
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        if complete:
+            self.orphans.extend(file for key, file in self.remote.items() if key not in local_keys)
+        else:
+            submitted_keys = {protocol_key(filename) for filename in self.submitted}
+            self.orphans = [file for file in self.orphans if protocol_key(file['name']) in submitted_keys]
+        failed = self.storage.delete(self.orphans)
+        self.summary['deleted'] = [file['name'] for file in self.orphans if file not in failed]
+        self.summary['seconds'] = time.perf_counter() - self.start
+
+        summary = self.summary
+        uploaded = len(summary['updated']) + len(summary['new'])
+        seconds = max(summary['seconds'], 1e-9)
+        self.logger.info(f"Drive sync: {len(summary['unchanged'])} unchanged, {len(summary['renamed'])} renamed, "
+                         f"{len(summary['updated'])} updated, {len(summary['new'])} new, "
+                         f"{len(summary['deleted'])} deleted, {len(summary['failed'])} failed, "
+                         f"{len(summary['skipped'])} skipped. Uploaded {uploaded} files ({summary['bytes'] / 1e6:.1f} "
+                         f"MB) in {summary['seconds']:.1f} s: {uploaded / seconds:.2f} files/s, "
+                         f"{summary['bytes'] / 1e6 / seconds:.2f} MB/s.")
+        for filename in summary['failed']:
+            self.logger.error(f'Failed synchronisation: {filename}')
+        return summary
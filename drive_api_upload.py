@@ -1,11 +1,16 @@
 from __future__ import print_function
 import os
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from drive_api_session import get_drive_session
+from drive_api_retry import get_request_executor
+from metrics import get_metrics
+
+# size of one resumable upload chunk; must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 
 def upload_basic(logger, token_path, filepath, filename, parents):
@@ -25,22 +30,138 @@ def upload_basic(logger, token_path, filepath, filename, parents):
     parents : list
         List of parent folder IDs.
     """
-    SCOPES = ['https://www.googleapis.com/auth/drive']
-    creds = Credentials.from_authorized_user_file(os.path.join(token_path, 'token.json'), SCOPES)
+    from googleapiclient.http import MediaFileUpload
 
     try:
-        # create drive api client
-        service = build('drive', 'v3', credentials=creds)
+        # get shared drive api client
+        service = get_drive_session(token_path).service
 
         file_metadata = {'name': filename,
                          'parents': parents}
         media = MediaFileUpload(os.path.join(filepath, filename),
                                 mimetype='application/pdf')
         # pylint: disable=maybe-no-member
-        file = service.files().create(body=file_metadata, media_body=media,
-                                      fields='id').execute()
+        file = get_request_executor().execute(service.files().create(body=file_metadata, media_body=media,
+                                                                     fields='id').execute)
+        get_metrics().count(api_calls=1, bytes=os.path.getsize(os.path.join(filepath, filename)))
         logger.info(f'Successful upload of {filename}')
 
     except HttpError as error:
         logger.error(F'An error occurred: {error}')
         file = None
+
+
+def upload_resumable(logger, token_path, filepath, filename, parents, file_id=None):
+    """
+    Upload a file in chunks with a resumable upload. Every chunk is sent with the shared request executor; if a
+    chunk fails, the upload continues from the last chunk the server received instead of starting over. If
+    file_id is given, the content of that file is replaced in place, so it keeps its ID and links.
+
+    Parameters
+    ----------
+    logger : logger object
+        logger object from the logging module.
+    token_path : str
+        Path to the folder containing the token.json file.
+    filepath : str
+        Path to the file to be uploaded.
+    filename : str
+        Name of the file to be uploaded.
+    parents : list
+        List of parent folder IDs.
+    file_id : str, optional
+        ID of an existing file in drive whose content should be replaced.
+
+    Returns
+    -------
+    file_id : str
+        ID of the uploaded file in drive.
+    """
+    # googleapiclient.http is only imported by the stage that uploads, it pulls in httplib2
+    from googleapiclient.http import MediaFileUpload
+
+    service = get_drive_session(token_path).service
+    media = MediaFileUpload(os.path.join(filepath, filename), mimetype='application/pdf',
+                            resumable=True, chunksize=UPLOAD_CHUNK_SIZE)
+    # pylint: disable=maybe-no-member
+    if file_id is None:
+        file_metadata = {'name': filename,
+                         'parents': parents}
+        request = service.files().create(body=file_metadata, media_body=media, fields='id')
+    else:
+        request = service.files().update(fileId=file_id, body={'name': filename}, media_body=media, fields='id')
+
+    executor = get_request_executor()
+    response = None
+    while response is None:
+        get_metrics().count(api_calls=1)
+        _, response = executor.execute(request.next_chunk)
+    get_metrics().count(bytes=media.size())
+    return response['id']
+
+
+def upload_many(logger, storage, filepath, filenames, parents, workers=4, file_ids=None):
+    """
+    Upload PDF files concurrently with resumable uploads and log a summary of the throughput
+
+    Parameters
+    ----------
+    logger : logger object
+        logger object from the logging module.
+    storage : StorageBackend
+        Storage the files are uploaded to, see storage_backend.
+    filepath : str
+        Path to the folder containing the files.
+    filenames : list
+        Names of the files to be uploaded; files that are not PDFs are skipped.
+    parents : list
+        List of parent folder IDs.
+    workers : int
+        Maximum number of simultaneous uploads.
+    file_ids : dict, optional
+        Maps filenames to the IDs of existing files in drive whose content should be replaced in place.
+
+    Returns
+    -------
+    summary : dict
+        Names of the uploaded, skipped and failed files, the number of uploaded bytes and the elapsed seconds.
+    """
+    file_ids = file_ids or {}
+    summary = {'uploaded': [], 'skipped': [], 'failed': [], 'bytes': 0, 'seconds': 0.0}
+    to_upload = []
+    for filename in filenames:
+        if filename.lower().endswith('.pdf') and os.path.isfile(os.path.join(filepath, filename)):
+            to_upload.append(filename)
+        else:
+            summary['skipped'].append(filename)
+            logger.info(f'Skipped upload of {filename}, not a PDF.')
+
+    def upload(filename):
+        with get_metrics().span('upload', file=filename):
+            return storage.upload(filepath, filename, parents, file_id=file_ids.get(filename))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(upload, filename): filename for filename in to_upload}
+        for future in as_completed(futures):
+            filename = futures[future]
+            # any error only fails this file, e.g. an exhausted retry or a failed token refresh
+            try:
+                future.result()
+            except Exception as error:
+                summary['failed'].append(filename)
+                logger.error(f'Upload of {filename} failed. Reason: {error}')
+                continue
+            summary['uploaded'].append(filename)
+            summary['bytes'] += os.path.getsize(os.path.join(filepath, filename))
+            logger.info(f'Successful upload of {filename}')
+    summary['seconds'] = time.perf_counter() - start
+
+    seconds = max(summary['seconds'], 1e-9)
+    logger.info(f"Uploaded {len(summary['uploaded'])} files ({summary['bytes'] / 1e6:.1f} MB) in "
+                f"{summary['seconds']:.1f} s: {len(summary['uploaded']) / seconds:.2f} files/s, "
+                f"{summary['bytes'] / 1e6 / seconds:.2f} MB/s. Skipped {len(summary['skipped'])}, "
+                f"failed {len(summary['failed'])}.")
+    for filename in summary['failed']:
+        logger.error(f'Failed upload: {filename}')
+    return summary
@@ -1,71 +1,111 @@
 from __future__ import print_function
 
-import io
 import os
 import glob
 import shutil
 import logging
+import argparse
 import configparser
 from datetime import datetime
 
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload
-from drive_api_download import export_excel
-from generate_protocols import DocumentGenerator
-from protocol_methods import clean_data_local
-from drive_api_upload import upload_basic
-from drive_api_folder import get_folder, clean_data_drive
+from drive_api_retry import RequestExecutor, get_request_executor, set_request_executor
+from metrics import MetricsRecorder, get_metrics, set_metrics
+
+# importing this module has no side effects; the configuration, log files and handlers are set up by setup, and
+# pandas, pylatex and the google client libraries are imported by the stages of exambot that use them
+logger = logging.getLogger(__name__)
 
-# Initialize the ConfigParser
-config = configparser.ConfigParser()
 
-# Read the ini file
-config.read('exambot.ini')
+def setup(config_file='exambot.ini'):
+    """
+    Reads the configuration, archives the logs of earlier runs and sets up the logger, the metrics file and the
+    request executor of a run
 
-# Access the values
-excel_ID = config['google_ID']['spreadsheet_ID']
-parent_folder_ID = config['google_ID']['parent_folder_ID']
-filepath = config['filepath']['filepath_local']
+    Parameters
+    ----------
+    config_file : str
+        Path to the ini file.
 
+    Returns
+    -------
+    settings : dict
+        Values of the ini file; optional values that are missing are filled in with their defaults.
+    """
+    # Initialize the ConfigParser
+    config = configparser.ConfigParser()
 
-# move old log files to archive
-full_path = os.path.join(filepath, '*.txt')
-files_to_transfer = glob.glob(full_path)
+    # Read the ini file
+    config.read(config_file)
 
-logger_path = os.path.join(filepath, 'Logger_archive')
-if not os.path.isdir(logger_path):
-    os.mkdir(logger_path)
+    # Access the values
+    settings = {
+        'spreadsheet_id': config['google_ID']['spreadsheet_ID'],
+        'parent_folder_id': config['google_ID']['parent_folder_ID'],
+        'filepath': config['filepath']['filepath_local'],
+        'workers': config.getint('generation', 'workers', fallback=os.cpu_count() or 1),
+        'force_rebuild': config.getboolean('generation', 'force_rebuild', fallback=False),
+        'backend': config.get('generation', 'backend', fallback='pylatex'),
+        'upload_workers': config.getint('upload', 'workers', fallback=4),
+        'sync': config.getboolean('upload', 'sync', fallback=True),
+        'slowest': config.getint('metrics', 'slowest', fallback=10),
+        'storage_backend': config.get('storage', 'backend', fallback='drive'),
+        'storage_root': config.get('storage', 'root', fallback=None),
+        'max_requests': config.getint('requests', 'concurrency', fallback=8),
+        'request_retries': config.getint('requests', 'retries', fallback=6),
+        'poll_interval': config.getfloat('watch', 'poll_interval', fallback=30.0),
+        'debounce': config.getfloat('watch', 'debounce', fallback=120.0),
+        'max_delay': config.getfloat('watch', 'max_delay', fallback=900.0),
+    }
+    if settings['storage_backend'] == 'local' and not settings['storage_root']:
+        raise Exception(f'{config_file}: [storage] backend = local requires root = <directory>.')
 
-for file_path in files_to_transfer:
-    try:
-        shutil.move(file_path, logger_path)
-        print(f'Successfully moved: {file_path}')
-    except Exception as e:
-        print(f'Error while moving file: {file_path}. Reason: {e}')
+    # move old log and metrics files to archive
+    files_to_transfer = glob.glob(os.path.join(settings['filepath'], '*.txt')) + \
+        glob.glob(os.path.join(settings['filepath'], '*_metrics.jsonl'))
 
+    logger_path = os.path.join(settings['filepath'], 'Logger_archive')
+    if not os.path.isdir(logger_path):
+        os.mkdir(logger_path)
 
-# Initialize logger
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)  # Set the logging level
+    for file_path in files_to_transfer:
+        try:
+            shutil.move(file_path, logger_path)
+            print(f'Successfully moved: {file_path}')
+        except Exception as e:
+            print(f'Error while moving file: {file_path}. Reason: {e}')
 
-# Create handlers
-log_filename = f"{datetime.now().year}{datetime.now().strftime('%m')}{datetime.now().strftime('%d')}_log.txt"
-file_handler = logging.FileHandler(log_filename, mode='w')
-console_handler = logging.StreamHandler()
+    # Initialize logger
+    logger.setLevel(logging.INFO)  # Set the logging level
 
-# Create formatters and add it to the handlers
-log_format = logging.Formatter('%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-file_handler.setFormatter(log_format)
-console_handler.setFormatter(log_format)
+    # Create handlers
+    log_filename = f"{datetime.now().year}{datetime.now().strftime('%m')}{datetime.now().strftime('%d')}_log.txt"
+    if not logger.handlers:
+        file_handler = logging.FileHandler(log_filename, mode='w')
+        console_handler = logging.StreamHandler()
 
-# Add handlers to the logger
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+        # Create formatters and add it to the handlers
+        log_format = logging.Formatter('%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+        file_handler.setFormatter(log_format)
+        console_handler.setFormatter(log_format)
 
+        # Add handlers to the logger
+        logger.addHandler(file_handler)
+        logger.addHandler(console_handler)
 
-def exambot(path, protocols_filename, folder_pdf='Protocol_PDF', folder_tex='Protocol_Latex'):
+    # timing spans of the run are written next to the log, one JSON object per line
+    metrics_filename = log_filename.replace('_log.txt', '_metrics.jsonl')
+    set_metrics(MetricsRecorder(logger, metrics_filename))
+
+    # all drive requests share one executor that retries rate limit errors and adapts the number of parallel
+    # requests
+    set_request_executor(RequestExecutor(logger, max_concurrency=settings['max_requests'],
+                                         retries=settings['request_retries']))
+    return settings
+
+
+def exambot(path, protocols_filename, spreadsheet_id, parent_folder_id, folder_pdf='Protocol_PDF',
+            folder_tex='Protocol_Latex', workers=1, force_rebuild=False, upload_workers=4, sync=True,
+            backend='pylatex', storage=None, depts=None, subjects=None, semesters=None):
     """
     Executes all functions needed to generate protocols from the data in the shared Google Drive.
 
@@ -74,33 +114,82 @@ def exambot(path, protocols_filename, folder_pdf='Protocol_PDF', folder_tex='Pro
     path : str
         Path to the folder containing the token.json file.
     protocols_filename : str
-        Name of the file containing the protocols.
+        Name under which a new export of the protocols spreadsheet is saved.
+    spreadsheet_id : str
+        ID of the protocols spreadsheet in the shared Google Drive.
+    parent_folder_id : str
+        ID of the folder in the shared Google Drive that contains the protocol folders.
     folder_pdf : str
         Name of the folder in the shared Google Drive where the PDF protocols should be saved.
     folder_tex : str
         Name of the folder in the shared Google Drive where the LaTeX protocols should be saved.
+    workers : int
+        Number of subjects that are compiled in parallel.
+    force_rebuild : bool
+        If True, all local protocols are deleted and every subject is rebuilt. Otherwise, only subjects whose
+        data changed since the last run are rebuilt.
+    upload_workers : int
+        Number of PDF protocols that are uploaded simultaneously.
+    sync : bool
+        If True, only new and changed protocols are uploaded and orphaned remote protocols deleted. Otherwise,
+        all remote protocols are deleted and all local protocols uploaded again.
+    backend : str
+        Rendering backend of the DocumentGenerator, 'pylatex' or 'stream'.
+    storage : StorageBackend, optional
+        Storage the spreadsheet is exported from and the protocols are uploaded to. Defaults to the shared
+        Google Drive.
+    depts : list, optional
+        If given, only subjects of these departments are regenerated.
+    subjects : list, optional
+        If given, only subjects matching one of these names or shell-style patterns are regenerated.
+    semesters : list, optional
+        If given, only subjects with responses from one of these semesters (names or patterns) are regenerated.
+
+    If any of depts, subjects or semesters is given, the matching subjects are always rebuilt and only their
+    PDFs are replaced in drive; all other local and remote protocols are left alone.
     """
+    from drive_api_download import export_excel, mark_spreadsheet_processed
 
-    # Delete old protocol spreadsheets
-    full_path = os.path.join(path, '*.xlsx')
-    files_to_delete = glob.glob(full_path)
+    targeted = bool(depts or subjects or semesters)
 
-    # Iterate over the list of files and delete each one
-    for file_path in files_to_delete:
+    metrics = get_metrics()
+
+    if storage is None:
+        from drive_api_session import get_drive_session
+        from storage_backend import DriveBackend
+
+        # create the drive session once; all drive_api_* functions reuse it
+        with metrics.span('drive_session'):
+            get_drive_session(path)
+        logger.info(f"Drive session created.")
+        storage = DriveBackend(logger, path)
+
+    # get sheet from drive; the download is skipped if the cached snapshot is still current
+    with metrics.span('export_excel'):
+        protocols_filename, changed = export_excel(
+            logger,
+            path=path,
+            filename=protocols_filename,
+            real_file_id=spreadsheet_id,
+            storage=storage
+        )
+    if protocols_filename is None:
+        logger.error(f"No protocol spreadsheet available, aborting.")
+        return
+    if not changed and not force_rebuild and not targeted:
+        logger.info(f"Spreadsheet unchanged and already processed, nothing to do.")
+        return
+
+    # Delete old protocol spreadsheets
+    for file_path in glob.glob(os.path.join(path, '*.xlsx')):
+        if os.path.basename(file_path) == protocols_filename:
+            continue
         try:
             os.remove(file_path)
             logger.info(f'Successfully deleted: {file_path}')
         except Exception as e:
             logger.error(f'Error while deleting file: {file_path}. Reason: {e}')
 
-    # get sheet from drive
-    export_excel(
-        logger,
-        path=path,
-        filename=protocols_filename,
-        real_file_id=excel_ID
-    )
-
     # Create folders if they don't exist
     if not os.path.isdir(folder_pdf):
         os.mkdir(folder_pdf)
@@ -109,32 +198,149 @@ def exambot(path, protocols_filename, folder_pdf='Protocol_PDF', folder_tex='Pro
         os.mkdir(folder_tex)
         logger.info(f"Created local folder {folder_tex}")
 
+    # pandas and pylatex are only needed from here on
+    from generate_protocols import DocumentGenerator
+    from protocol_methods import clean_data_local
+
     # create instance of DocumentGenerator
-    pdf_gen = DocumentGenerator(logger, path, protocols_filename, folder_pdf, folder_tex)  
-    
-    # clean data
-    logger.info(f"Cleaning data...")
-    clean_data_local(logger, pdf_gen.folder_path_pdf)
-    clean_data_local(logger, pdf_gen.folder_path_tex)
-    logger.info(f"Data cleaned.")
-
-    # generate all protocols
-    logger.info(f"Generating protocols...")
-    pdf_gen.generate_all_protocols()
-    logger.info(f"Protocols generated.")
+    with metrics.span('load_protocols'):
+        pdf_gen = DocumentGenerator(logger, path, protocols_filename, folder_pdf, folder_tex, backend=backend)
     
-    # delete all files in respective drive folder
-    folder_id = get_folder(logger, path=path, folder_name=folder_pdf, parent_folder_id=parent_folder_ID)
-    logger.info(f"Deleting old remotely stored PDF protocols...")
-    clean_data_drive(logger, path, folder_id)
-    logger.info(f"Old remote PDF protocols deleted.")
-    logger.info(f"Uploading new PDF protocols...")
-    for file in os.listdir(pdf_gen.folder_path_pdf):
-        upload_basic(logger, path, pdf_gen.folder_path_pdf, file, folder_id)
-    logger.info(f"New PDF protocols uploaded.")
+    # clean data; incremental and targeted runs keep the protocols of the other subjects
+    if force_rebuild and not targeted:
+        logger.info(f"Cleaning data...")
+        with metrics.span('clean_local'):
+            clean_data_local(logger, pdf_gen.folder_path_pdf)
+            clean_data_local(logger, pdf_gen.folder_path_tex)
+        logger.info(f"Data cleaned.")
+
+    with metrics.span('get_folder'):
+        folder_id = storage.find_folder(folder_pdf, parent_folder_id=parent_folder_id)
+    if sync or targeted:
+        from drive_api_sync import SyncPipeline
+
+        # upload every PDF as soon as it is compiled; the pipeline lists the remote folder once up front
+        logger.info(f"Generating protocols and synchronising them with drive...")
+        with metrics.span('list_remote'):
+            pipeline = SyncPipeline(logger, storage, pdf_gen.folder_path_pdf, folder_id, workers=upload_workers)
+        with metrics.span('generate'):
+            results = pdf_gen.generate_all_protocols(workers=workers, force=force_rebuild or targeted,
+                                                     on_protocol=pipeline.submit, depts=depts, subjects=subjects,
+                                                     semesters=semesters)
+        logger.info(f"Protocols generated.")
+        with metrics.span('sync_finish'):
+            failed = pipeline.finish(complete=not targeted)['failed']
+        logger.info(f"PDF protocols synchronised.")
+    else:
+        from googleapiclient.errors import HttpError
+        from drive_api_upload import upload_many
+
+        # generate all protocols
+        logger.info(f"Generating protocols...")
+        with metrics.span('generate'):
+            results = pdf_gen.generate_all_protocols(workers=workers, force=force_rebuild)
+        logger.info(f"Protocols generated.")
+
+        # delete all files in respective drive folder
+        logger.info(f"Deleting old remotely stored PDF protocols...")
+        with metrics.span('clean_drive'):
+            try:
+                storage.delete(storage.list_folder(folder_id))
+            except HttpError as error:
+                logger.error(F'An error occurred: {error}')
+        logger.info(f"Old remote PDF protocols deleted.")
+        logger.info(f"Uploading new PDF protocols...")
+        with metrics.span('upload_all'):
+            failed = upload_many(logger, storage, pdf_gen.folder_path_pdf, os.listdir(pdf_gen.folder_path_pdf),
+                                 folder_id, workers=upload_workers)['failed']
+        logger.info(f"New PDF protocols uploaded.")
+
+    # the next run may only skip this spreadsheet if all of its protocols reached drive
+    if not targeted and not failed and all(error is None for error in results.values()):
+        mark_spreadsheet_processed(path)
+
+
+def parse_arguments(settings):
+    """
+    Parses the command line; the defaults come from exambot.ini
+
+    Parameters
+    ----------
+    settings : dict
+        Settings returned by setup.
+
+    Returns
+    -------
+    args : argparse.Namespace
+        Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Generate the exam protocols from the protocols spreadsheet and upload them to drive. Without '
+                    'filters, every changed subject is regenerated; with filters, only the matching subjects are '
+                    'regenerated and replaced in drive.')
+    parser.add_argument('-d', '--dept', action='append', choices=['itet', 'phys', 'other'], dest='depts',
+                        help='only regenerate subjects of this department; can be repeated')
+    parser.add_argument('-s', '--subject', action='append', dest='subjects', metavar='PATTERN',
+                        help='only regenerate subjects matching this name or pattern, e.g. "Analysis*"; '
+                             'can be repeated')
+    parser.add_argument('--semester', action='append', dest='semesters', metavar='PATTERN',
+                        help='only regenerate subjects with responses from this semester, e.g. "Fall 2023" or '
+                             '"*2023"; can be repeated')
+    parser.add_argument('-f', '--force', action='store_true', default=settings['force_rebuild'],
+                        help='rebuild all protocols, even if the spreadsheet did not change')
+    parser.add_argument('-w', '--workers', type=int, default=settings['workers'],
+                        help='number of subjects compiled in parallel')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and regenerate the changed subjects whenever the spreadsheet is edited')
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    path = filepath
-    protocols_filename = f"{datetime.now().year}{datetime.now().strftime('%m')}{datetime.now().strftime('%d')}_protocols.xlsx"
-    exambot(path=path, protocols_filename=protocols_filename)
+    settings = setup()
+    args = parse_arguments(settings)
+    path = settings['filepath']
+    storage = None
+    if settings['storage_backend'] == 'local':
+        from storage_backend import LocalBackend
+        storage = LocalBackend(logger, settings['storage_root'])
+
+    watcher = None
+    if args.watch:
+        from drive_api_changes import ChangeWatcher
+        if storage is None:
+            from storage_backend import DriveBackend
+            storage = DriveBackend(logger, path)
+        # follow the changes feed from before the first run, so edits made during a run trigger the next one
+        watcher = ChangeWatcher(logger, storage, settings['spreadsheet_id'], poll_interval=settings['poll_interval'],
+                                debounce=settings['debounce'], max_delay=settings['max_delay'])
+        logger.info(f"Watching the spreadsheet for changes.")
+
+    try:
+        while True:
+            protocols_filename = f"{datetime.now().year}{datetime.now().strftime('%m')}{datetime.now().strftime('%d')}_protocols.xlsx"
+            try:
+                with get_metrics().span('exambot'):
+                    exambot(path=path, protocols_filename=protocols_filename, spreadsheet_id=settings['spreadsheet_id'],
+                            parent_folder_id=settings['parent_folder_id'], workers=args.workers,
+                            force_rebuild=args.force, upload_workers=settings['upload_workers'], sync=settings['sync'],
+                            backend=settings['backend'], storage=storage, depts=args.depts, subjects=args.subjects,
+                            semesters=args.semesters)
+            except Exception as e:
+                if watcher is None:
+                    raise
+                logger.error(f'Run failed, waiting for the next change. Reason: {e}')
+            get_metrics().summary(settings['slowest'])
+            stats = get_request_executor().stats
+            logger.info(f"Drive requests: {stats['requests']} made, {stats['retries']} retried, "
+                        f"{stats['rate_limited']} rate limited, {stats['failed']} failed.")
+            if watcher is None or not watcher.wait():
+                break
+            # only the first run rebuilds everything if --force is given; later runs are incremental
+            args.force = False
+            get_metrics().clear()
+    except KeyboardInterrupt:
+        if watcher is None:
+            raise
+        logger.info(f"Watch mode stopped.")
+    finally:
+        get_metrics().close()
@@ -1,19 +1,28 @@
 import os
 import shutil
 import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 from datetime import datetime
 from pylatex.utils import NoEscape, bold
 from pylatex import Document, Command, LargeText, MediumText, LineBreak, NewPage
-from protocol_methods import filter_string, split_tex, create_tex_preamble
-
+from pylatex.errors import CompilerError
+from protocol_methods import sanitize_columns, split_tex, create_tex_preamble, build_preamble_format, semester_key, \
+    compile_tex, matches_any, scratch_directory, install_file
+from tex_writer import TexStreamWriter
+from build_manifest import BuildManifest, subject_hash
+from protocol_cache import load_protocols
+from metrics import get_metrics
 
 class DocumentGenerator:
     """
     Class to generate protocols from a given datasheet
     """
-    def __init__(self, logger, path, filename, folder_pdf, folder_tex):
+    def __init__(self, logger, path, filename, folder_pdf, folder_tex, backend='pylatex'):
         """
         Initialize DocumentGenerator class
 
@@ -29,28 +38,243 @@ class DocumentGenerator:
             Name of the folder in the shared Google Drive where the PDF protocols should be saved.
         folder_tex : str
             Name of the folder in the shared Google Drive where the LaTeX protocols should be saved.
+        backend : str
+            How the tex files are rendered: 'pylatex' builds a pylatex document first, 'stream' writes the
+            same LaTeX code straight to the file.
         """
+        if backend not in ['pylatex', 'stream']:
+            raise Exception(f"Invalid backend {backend} entered. Only 'pylatex' and 'stream' are valid backends.")
         self.logger = logger
+        self.backend = backend
         self.valid_dept = ["itet", "phys", "other"]
         self.folder_path_pdf = os.path.join(path, folder_pdf)
         self.folder_path_tex = os.path.join(path, folder_tex)
-        self.full_df = pd.read_excel(os.path.join(path, filename), sheet_name='Sheet2', engine='openpyxl')
+        self.full_df = load_protocols(logger, path, filename)
+        self.watermark = '2023_04_QEC.png'
+        self.manifest = BuildManifest(logger, os.path.join(path, 'build_manifest.json'))
+        self.cache_path = os.path.join(path, '.cache')
+        self.use_format = True
+        self.tex_format = None
+        self.scratch_path = scratch_directory()
+        self.workspace = threading.local()
+        self.build_dirs = []
+        self.build_dirs_lock = threading.Lock()
 
-    def generate_all_protocols(self):
+    def generate_all_protocols(self, workers=1, force=False, on_protocol=None, depts=None, subjects=None,
+                               semesters=None):
         """
-        Generates tex files and compiles to PDF for all subjects and their respective data in a given datasheet
+        Generates tex files and compiles to PDF for all subjects and their respective data in a given datasheet.
+        Subjects whose data did not change since the last run are skipped, unless force is set. If depts,
+        subjects or semesters are given, only the matching subjects are generated, see select_subjects, and
+        protocols of subjects that no longer exist are kept.
+
+        Parameters
+        ----------
+        workers : int
+            Number of subjects that are built and compiled in parallel.
+        force : bool
+            If True, all subjects are rebuilt regardless of the build manifest.
+        on_protocol : callable, optional
+            Called with the filename of every newly generated PDF as soon as it is ready, e.g. to upload it
+            while the remaining subjects are still compiling.
+        depts : list, optional
+            Departments whose subjects should be generated.
+        subjects : list, optional
+            Subject names or shell-style patterns such as "Analysis*" of the subjects that should be generated.
+        semesters : list, optional
+            Semester names or patterns; only subjects with responses from one of them are generated.
+
+        Returns
+        -------
+        results : dict
+            Maps the (department, subject) of every rebuilt subject to None if its PDF was generated, otherwise to
+            the error message.
         """
-        # need image as watermark in pdf folder
-        shutil.copy('2023_04_QEC.png', self.folder_path_pdf) 
+        metrics = get_metrics()
 
-        # generate protocols for all subjects 
-        depts_subjects_df = self.get_valid_subjects(self.full_df)
-        for dept, subject in zip(depts_subjects_df['Department'], depts_subjects_df['Subject']):
-            subject_df = self.get_subject_data(self.full_df, subject, dept)
-            self.make_subject_tex(subject, subject_df)
+        # filter the text of all responses at once instead of cell by cell while building the documents
+        with metrics.span('prepare_data'):
+            data = pd.concat([self.full_df, sanitize_columns(self.full_df)], axis=1, copy=False)
+            subject_groups = self.group_subjects(data)
+            del data
+        names = self.protocol_names(subject_groups)
+        targeted = bool(depts or subjects or semesters)
+        selected_groups = subject_groups
+        if targeted:
+            selected_groups = self.select_subjects(subject_groups, depts, subjects, semesters)
+            self.logger.info(f'Selected {len(selected_groups)} of {len(subject_groups)} subjects.')
+        jobs = []
+        skipped = 0
+        with metrics.span('hash_subjects'):
+            for (dept, subject), semester_groups in selected_groups.items():
+                content_hash = subject_hash(dept, subject, semester_groups)
+                if not force and self.manifest.is_current(dept, subject, content_hash, self.folder_path_pdf,
+                                                          names[(dept, subject)]):
+                    skipped += 1
+                    continue
+                jobs.append((dept, subject, semester_groups, content_hash))
+
+        # load the preamble packages once for all subjects
+        if jobs and self.use_format:
+            with metrics.span('preamble_format'):
+                self.tex_format = build_preamble_format(self.logger, self.cache_path)
+
+        # every worker compiles in its own scratch directory, so workers never share files
+        results = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                futures = {executor.submit(self.make_subject_tex, subject, semester_groups, names[(dept, subject)]):
+                           (dept, subject, content_hash) for dept, subject, semester_groups, content_hash in jobs}
+                for future in as_completed(futures):
+                    dept, subject, content_hash = futures[future]
+                    try:
+                        basename = future.result()
+                        results[(dept, subject)] = None
+                    except Exception as e:
+                        self.logger.error(f'PDF generation failed for {names[(dept, subject)]}. Reason: {e}')
+                        results[(dept, subject)] = str(e)
+                        continue
+                    old_basename = self.manifest.update(dept, subject, content_hash, basename)
+                    if old_basename is not None:
+                        self.remove_protocol(old_basename)
+                    if on_protocol is not None:
+                        on_protocol(f'{basename}.pdf')
+        finally:
+            self.remove_build_dirs()
+
+        # remove protocols of subjects that no longer exist in the datasheet
+        if not targeted:
+            for dept, subject in set(self.manifest.keys()) - set(subject_groups):
+                self.remove_protocol(self.manifest.remove(dept, subject))
+                self.logger.info(f'Removed protocol of {subject} ({dept}), subject no longer exists.')
+        self.manifest.save()
+
+        self.report_results(results, skipped)
+        return results
+
+    def protocol_names(self, subject_groups):
+        """
+        Names the protocols are saved under. A subject that exists in several departments gets the department
+        appended, so the protocols of the departments do not overwrite each other.
+
+        Parameters
+        ----------
+        subject_groups : dict
+            Maps (department, subject) to a list of (semester, semester_df) pairs, see group_subjects.
+
+        Returns
+        -------
+        names : dict
+            Maps (department, subject) to the name used in the filenames of its protocol.
+        """
+        depts_of_subject = {}
+        for dept, subject in subject_groups:
+            depts_of_subject.setdefault(subject, []).append(dept)
+        names = {}
+        for subject, subject_depts in depts_of_subject.items():
+            if len(subject_depts) > 1:
+                self.logger.info(f'Subject {subject} exists in the departments {", ".join(subject_depts)}, its '
+                                 f'protocols are named after the department.')
+            for dept in subject_depts:
+                names[(dept, subject)] = f'{subject} ({dept})' if len(subject_depts) > 1 else subject
+        return names
+
+    def select_subjects(self, subject_groups, depts=None, subjects=None, semesters=None):
+        """
+        Selects the subjects matching all given filters
+
+        Parameters
+        ----------
+        subject_groups : dict
+            Maps (department, subject) to a list of (semester, semester_df) pairs, see group_subjects.
+        depts : list, optional
+            Department names.
+        subjects : list, optional
+            Subject names or shell-style patterns, matched ignoring the case.
+        semesters : list, optional
+            Semester names or shell-style patterns, matched ignoring the case. A subject matches if it has
+            responses from one of the semesters; its protocol still contains all semesters.
+
+        Returns
+        -------
+        selected_groups : dict
+            The entries of subject_groups that match the filters.
+        """
+        for dept in depts or []:
+            if dept not in self.valid_dept:
+                raise Exception(f"Invalid dept {dept} entered. Only these keys are valid departments: "
+                                f"{self.valid_dept}.")
+        selected_groups = {}
+        for (dept, subject), semester_groups in subject_groups.items():
+            if depts and dept not in depts:
+                continue
+            if subjects and not matches_any(subject, subjects):
+                continue
+            if semesters and not any(matches_any(semester, semesters) for semester, _ in semester_groups):
+                continue
+            selected_groups[(dept, subject)] = semester_groups
+        return selected_groups
+
+    def remove_protocol(self, basename):
+        """
+        Deletes the local tex and PDF file of a protocol, if they exist
+
+        Parameters
+        ----------
+        basename : str
+            Filename of the protocol without extension.
+        """
+        for file_path in [os.path.join(self.folder_path_pdf, f'{basename}.pdf'),
+                          os.path.join(self.folder_path_tex, f'{basename}.tex')]:
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+                self.logger.info(f'Deleted {file_path}')
+
+    def worker_build_dir(self):
+        """
+        Scratch directory of the calling worker thread in scratch_path. It is created on first use with a copy of
+        the watermark and reused for every subject the worker compiles.
+
+        Returns
+        -------
+        build_dir : str
+            Path to the scratch directory.
+        """
+        build_dir = getattr(self.workspace, 'build_dir', None)
+        if build_dir is None or not os.path.isdir(build_dir):
+            build_dir = tempfile.mkdtemp(prefix='exambot_', dir=self.scratch_path)
+            shutil.copy(self.watermark, build_dir)
+            self.workspace.build_dir = build_dir
+            with self.build_dirs_lock:
+                self.build_dirs.append(build_dir)
+        return build_dir
+
+    def remove_build_dirs(self):
+        """
+        Deletes the scratch directories of all workers
+        """
+        with self.build_dirs_lock:
+            build_dirs, self.build_dirs = self.build_dirs, []
+        for build_dir in build_dirs:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    def report_results(self, results, skipped=0):
+        """
+        Logs a summary of the generated and failed protocols
 
-        # remove image; we don't want it to be uploaded
-        os.remove(os.path.join(self.folder_path_pdf, r'2023_04_QEC.png'))  
+        Parameters
+        ----------
+        results : dict
+            Maps the (department, subject) of every rebuilt subject to None if its PDF was generated, otherwise to
+            the error message.
+        skipped : int
+            Number of unchanged subjects that were not rebuilt.
+        """
+        failed = {key: error for key, error in results.items() if error is not None}
+        self.logger.info(f'Generated {len(results) - len(failed)} of {len(results)} protocols, '
+                         f'{skipped} unchanged protocols skipped.')
+        for (dept, subject), error in sorted(failed.items()):
+            self.logger.error(f'Failed: {subject} ({dept}). Reason: {error}')
 
     def get_valid_subjects(self, data):
         """
@@ -66,17 +290,71 @@ class DocumentGenerator:
         depts_subjects_df : pandas dataframe
             Dataframe containing all valid subjects and their respective departments.
         """
-        depts_subjects_df = pd.DataFrame(columns=['Department', 'Subject'])
-        for dept in self.valid_dept:
-            dept_subject_df = pd.DataFrame(
-                {'Department': [dept] * len(data[f'Subject_{dept}'].dropna().drop_duplicates()),
-                 'Subject': data[f'Subject_{dept}'].dropna().drop_duplicates()})
-            depts_subjects_df = pd.concat([depts_subjects_df, dept_subject_df], ignore_index=True)
+        depts_subjects_df = pd.concat(
+            [pd.DataFrame({'Department': dept, 'Subject': data[f'Subject_{dept}'].dropna().drop_duplicates()})
+             for dept in self.valid_dept],
+            ignore_index=True)
         return depts_subjects_df
 
+    def group_subjects(self, data):
+        """
+        Partitions the data by department, subject and semester in a single pass.
+
+        Parameters
+        ----------
+        data : pandas dataframe
+            Dataframe containing all the data.
+
+        Returns
+        -------
+        subject_groups : dict
+            Maps (department, subject) to a list of (semester, semester_df) pairs, latest semester first.
+            Semesters that cannot be parsed come last. Every semester_df is a view into one frame that holds the
+            responses of all subjects without the Subject_<dept> columns.
+        """
+        # only the row positions, departments, subjects and semesters are stacked and sorted; the responses
+        # themselves are copied once into the order of the groups
+        # the keys are categoricals like the columns they come from; the subjects of all departments share one set
+        # of categories
+        dept_rows = [np.flatnonzero(data[f'Subject_{dept}'].notna().to_numpy()) for dept in self.valid_dept]
+        rows = np.concatenate(dept_rows)
+        keys = pd.DataFrame({
+            'Department': pd.Categorical.from_codes(np.repeat(np.arange(len(self.valid_dept)),
+                                                              [len(dept_row) for dept_row in dept_rows]),
+                                                    categories=self.valid_dept),
+            'Subject': union_categoricals([pd.Categorical(data[f'Subject_{dept}'].iloc[dept_row])
+                                           for dept, dept_row in zip(self.valid_dept, dept_rows)]),
+            'Semester': pd.Categorical(data['Semester'].iloc[rows]),
+            'Row': rows})
+
+        # parse every distinct semester once and sort by it; the stable sort keeps the order of the responses
+        # within a semester
+        semester_keys = {semester: semester_key(semester) for semester in keys['Semester'].dropna().unique()}
+        for semester, key in semester_keys.items():
+            if key < 0:
+                self.logger.info(f'Could not parse semester {semester}, it is listed last.')
+        keys = keys.dropna(subset=['Semester'])
+        keys = keys.iloc[np.argsort(-keys['Semester'].map(semester_keys).to_numpy(dtype=float), kind='stable')]
+
+        # number the groups in the order they first appear and bring the rows of every group together
+        group = keys.groupby(['Department', 'Subject', 'Semester'], sort=False, observed=True).ngroup().to_numpy()
+        order = np.argsort(group, kind='stable')
+        keys, group = keys.iloc[order], group[order]
+        columns = ~data.columns.astype(str).str.startswith('Subject_')
+        long_df = data.iloc[keys['Row'].to_numpy(), columns].reset_index(drop=True)
+
+        subject_groups = {}
+        starts = np.flatnonzero(np.diff(group, prepend=-1))
+        depts, subjects, semesters = (keys[column].to_numpy()[starts]
+                                      for column in ['Department', 'Subject', 'Semester'])
+        for dept, subject, semester, start, stop in zip(depts, subjects, semesters, starts,
+                                                        np.append(starts[1:], len(group))):
+            subject_groups.setdefault((dept, subject), []).append((semester, long_df.iloc[start:stop]))
+        return subject_groups
+
     def get_subject_data(self, data, subject, dept):
         """
-        Get all text responses for a specific subject from a specific department sorted by semester (latest = pos 0)
+        Get all text responses for a specific subject from a specific department
 
         Parameters
         ----------
@@ -92,49 +370,104 @@ class DocumentGenerator:
         subject_df : pandas dataframe
             Dataframe containing all the data for a given subject.
         """
-        depts_subjects_df = self.get_valid_subjects(data)
-        valid_depts = depts_subjects_df['Department'].drop_duplicates().to_list()
-        valid_subjects = depts_subjects_df['Subject'].drop_duplicates().to_list()
-
         # check if dept and subject are valid
-        if dept not in valid_depts:
-            raise Exception(f"Invalid dept {dept} entered. Only these keys are valid departments: {valid_depts}.")
-        if subject not in valid_subjects:
-            raise Exception(f"Invalid dept {subject} entered. Only these keys are valid subjects: {valid_subjects}.")
-        
-        # get all data for a given subject
+        if dept not in self.valid_dept:
+            raise Exception(f"Invalid dept {dept} entered. Only these keys are valid departments: {self.valid_dept}.")
         index = data[f'Subject_{dept}'] == subject
+        if not index.any():
+            raise Exception(f"Invalid subject {subject} entered for dept {dept}.")
+
+        # get all data for a given subject
         subject_df = data[index]
         return subject_df
 
-    def make_subject_tex(self, subject, subject_df):
+    def make_subject_tex(self, subject, semester_groups, name=None):
         """
-        Creates a tex file and compiles a PDF for one subject and saves them in respective folders
+        Creates a tex file and compiles a PDF for one subject in the scratch directory of the worker and moves them
+        into their folders; the PDF is only moved once it is complete
 
         Parameters
         ----------
         subject : str
             Subject name.
-        subject_df : pandas dataframe
-            Dataframe containing all the data for a given subject.
+        semester_groups : list
+            (semester, semester_df) pairs with the responses of the subject in the order they should appear,
+            see group_subjects. The rows need the filtered text columns from sanitize_columns.
+        name : str, optional
+            Name used in the filenames instead of the subject name, see protocol_names.
+
+        Returns
+        -------
+        basename : str
+            Filename of the generated tex and PDF files without extension.
         """
-        if subject_df.empty:
+        name = name or subject
+        if not semester_groups:
             self.logger.info(f'No data for {subject}, moving on to next one.')
 
-        # TODO: do a smarter way of encoding semester
-        # hardcoded dict to encode semester to LaTeX format
-        encoded_semester = {
-            'Fall 2025': '2025B', 'Spring 2025': '2025A',
-            'Fall 2024': '2024B', 'Spring 2024': '2024A',
-            'Fall 2023': '2023B', 'Spring 2023': '2023A', 
-            'Fall 2022': '2022B', 'Spring 2022': '2022A',
-            'Fall 2021': '2021B', 'Spring 2021': '2021A',
-            'Fall 2020': '2020B', 'Spring 2020': '2020A',
-            'Fall 2019': '2019B'
-        }
+        metrics = get_metrics()
+        with metrics.span('subject', subject=name, responses=sum(len(df) for _, df in semester_groups)):
+            # Generate the LaTeX document and the PDF
+            basename = f"{datetime.now().year}{datetime.now().strftime('%m')}{datetime.now().strftime('%d')}_{name}"
+            build_dir = self.worker_build_dir()
+            tex_path = os.path.join(build_dir, f'{basename}.tex')
+            pdf_path = os.path.join(build_dir, f'{basename}.pdf')
+            try:
+                # the tex file is written once, into the scratch directory, and compiled there
+                with metrics.span('tex_build', subject=subject):
+                    self.write_tex(subject, semester_groups, tex_path)
+                    metrics.count(bytes=os.path.getsize(tex_path))
+                with metrics.span('compile', subject=subject):
+                    self.compile_pdf(build_dir, basename)
+                    metrics.count(bytes=os.path.getsize(pdf_path))
+                # only a successful build is moved into the protocol folders, so a failed subject leaves no files
+                # behind that the manifest does not know about
+                install_file(tex_path, os.path.join(self.folder_path_tex, f'{basename}.tex'))
+                install_file(pdf_path, os.path.join(self.folder_path_pdf, f'{basename}.pdf'))
+            finally:
+                # keep the watermark and the preamble format for the next subject of this worker
+                for filename in os.listdir(build_dir):
+                    if filename != os.path.basename(self.watermark) and not filename.endswith('.fmt'):
+                        os.remove(os.path.join(build_dir, filename))
+        self.logger.info(f'PDF generated for {name}.')
+        return basename
+
+    def write_tex(self, subject, semester_groups, tex_path):
+        """
+        Writes the tex file of one subject with the selected backend
+
+        Parameters
+        ----------
+        subject : str
+            Subject name.
+        semester_groups : list
+            (semester, semester_df) pairs with the responses of the subject, see make_subject_tex.
+        tex_path : str
+            Path of the tex file.
+        """
+        if self.backend == 'stream':
+            with open(tex_path, 'w', encoding='utf-8') as tex_file:
+                writer = TexStreamWriter(tex_file)
+                self.add_protocol_content(writer, subject, semester_groups)
+                writer.close()
+        else:
+            doc = create_tex_preamble()
+            self.add_protocol_content(doc, subject, semester_groups)
+            doc.generate_tex(tex_path[:-len('.tex')])
 
-        doc = create_tex_preamble()
+    def add_protocol_content(self, doc, subject, semester_groups):
+        """
+        Adds the title and all responses of one subject to a document
 
+        Parameters
+        ----------
+        doc : pylatex document or TexStreamWriter
+            Document to which the content should be added.
+        subject : str
+            Subject name.
+        semester_groups : list
+            (semester, semester_df) pairs with the responses of the subject, see make_subject_tex.
+        """
         # Add document title
         doc.append(NoEscape(r'\begin{center}'))
         doc.append(LargeText(bold(subject)))
@@ -142,23 +475,19 @@ class DocumentGenerator:
         doc.append(NoEscape(r'\end{center}'))
 
         # Add content to the document
-        for semester in encoded_semester.keys():
-
-            # Create df with subject data for each semester; skip, if empty
-            semester_subject_df = subject_df[subject_df['Semester'] == semester]
-            if semester_subject_df.empty:
-                continue
-            examiner = np.sort(semester_subject_df['Examiner'].dropna().unique())[0]
+        for semester, semester_subject_df in semester_groups:
+            examiner = semester_subject_df['Examiner'].dropna().astype(object).min()
 
             # Add title for each semester
             doc.append(NoEscape(r'\begin{center}'))
             doc.append(MediumText(bold(f'{semester}, Examiner: {examiner}')))
             doc.append(NoEscape(r'\end{center}'))
             doc.append(NoEscape(r'\begin{enumerate}'))
-            for i in range(0, len(semester_subject_df['Summary'])):
-
-                # get filtered string and latex yes/no
-                filter_summary, latex = filter_string(semester_subject_df['Summary'].iloc[i])
+            entries = zip(semester_subject_df['Summary_text'], semester_subject_df['Summary_latex'],
+                          semester_subject_df['Atmosphere_text'])
+            for i, (filter_summary, latex, filter_atmosphere) in enumerate(entries):
+                if filter_summary is None:
+                    filter_summary = "-"
 
                 # Add grey opaque box around every second entry
                 doc.append(NoEscape(r'\item'))
@@ -172,8 +501,7 @@ class DocumentGenerator:
                     split_tex(doc, filter_summary)
                 else:
                     doc.append(filter_summary)
-                if isinstance(semester_subject_df['Atmosphere'].iloc[i], str):
-                    filter_atmosphere, _ = filter_string(semester_subject_df['Atmosphere'].iloc[i])
+                if filter_atmosphere is not None:
                     doc.append(NoEscape(r'\newline'))
                     doc.append(NoEscape(r'\newline'))
                     doc.append(bold('Exam atmosphere:'))
@@ -185,10 +513,35 @@ class DocumentGenerator:
             doc.append(NoEscape(r'\end{enumerate}'))
             doc.append(NewPage())
 
-        # Generate the LaTeX document and the PDF
-        doc.generate_tex(os.path.join(self.folder_path_tex,
-                                      f"{datetime.now().year}{datetime.now().strftime('%m')}{datetime.now().strftime('%d')}_{subject}"))
-        doc.generate_pdf(os.path.join(self.folder_path_pdf,
-                                      f"{datetime.now().year}{datetime.now().strftime('%m')}{datetime.now().strftime('%d')}_{subject}"),
-                         clean_tex=True, compiler='pdflatex')
-        self.logger.info(f'PDF generated for {subject}.')
+    def compile_pdf(self, build_dir, basename):
+        """
+        Compiles a tex file to PDF, using the precompiled preamble format if there is one. If the format turns out
+        to be unusable, the document is compiled with its full preamble and the format is not used anymore.
+
+        Parameters
+        ----------
+        build_dir : str
+            Path to the working directory containing the tex file.
+        basename : str
+            Filename of the tex file without extension.
+        """
+        tex_format = self.tex_format
+        if tex_format is not None:
+            fmt_file = os.path.abspath(os.path.join(self.cache_path, f'{tex_format}.fmt'))
+            if not os.path.exists(os.path.join(build_dir, f'{tex_format}.fmt')):
+                try:
+                    os.symlink(fmt_file, os.path.join(build_dir, f'{tex_format}.fmt'))
+                except OSError:
+                    shutil.copy(fmt_file, build_dir)
+            try:
+                compile_tex(build_dir, basename, fmt_name=tex_format)
+                return
+            except CompilerError as e:
+                format_error = e
+
+        compile_tex(build_dir, basename)
+        if tex_format is not None and self.tex_format is not None:
+            # the full preamble works, so the format was the problem
+            self.logger.error(f'Compiling with preamble format {tex_format} failed, using the full preamble from '
+                              f'now on. Reason: {format_error}')
+            self.tex_format = None
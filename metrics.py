@@ -0,0 +1,168 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# fields every span has; everything else is a label such as the subject or filename
+SPAN_FIELDS = ('span', 'parent', 'start', 'seconds', 'status', 'error', 'thread', 'bytes', 'api_calls')
+
+
+class MetricsRecorder:
+    """
+    Records timing spans of a run and writes every finished span as one line of JSON
+    """
+    def __init__(self, logger=None, metrics_path=None):
+        """
+        Initialize MetricsRecorder class
+
+        Parameters
+        ----------
+        logger : logger object, optional
+            logger object from the logging module, used for the summary.
+        metrics_path : str, optional
+            Path to the JSON-lines file the spans are written to. Without it, the spans are only kept in memory.
+        """
+        self.logger = logger
+        self.metrics_path = metrics_path
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.file = open(metrics_path, 'w', encoding='utf-8') if metrics_path is not None else None
+
+    def open_spans(self):
+        """
+        Spans that are currently open in the calling thread, innermost last
+        """
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Measures the wall time of a block. Spans opened inside the block in the same thread are nested into it.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage, e.g. 'compile'.
+        labels : dict
+            Additional fields stored with the span, e.g. subject='Analysis I'.
+
+        Yields
+        ------
+        record : dict
+            The span; bytes and api_calls are counted with count, further fields can be set directly.
+        """
+        stack = self.open_spans()
+        record = {'span': name, 'parent': stack[-1]['span'] if stack else None,
+                  'start': datetime.now().isoformat(timespec='milliseconds'),
+                  'thread': threading.current_thread().name, 'bytes': 0, 'api_calls': 0, **labels}
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = str(e)
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            # spans of a thread are nested, so the record is the innermost one
+            stack.pop()
+            self.write(record)
+
+    def count(self, **counts):
+        """
+        Adds counts, e.g. bytes=1024 or api_calls=1, to all spans that are open in the calling thread
+
+        Parameters
+        ----------
+        counts : dict
+            Maps a field to the amount it should be increased by.
+        """
+        for record in self.open_spans():
+            for field, amount in counts.items():
+                record[field] = record.get(field, 0) + amount
+
+    def write(self, record):
+        """
+        Stores a finished span and appends it to the metrics file
+
+        Parameters
+        ----------
+        record : dict
+            Finished span.
+        """
+        with self.lock:
+            self.spans.append(record)
+            if self.file is not None:
+                self.file.write(json.dumps(record, default=str) + '\n')
+                self.file.flush()
+
+    def summary(self, top=10):
+        """
+        Logs the slowest spans of the run
+
+        Parameters
+        ----------
+        top : int
+            Number of spans to list.
+
+        Returns
+        -------
+        slowest : list
+            The slowest spans, slowest first.
+        """
+        with self.lock:
+            slowest = sorted(self.spans, key=lambda record: record['seconds'], reverse=True)[:top]
+        if self.logger is not None and slowest:
+            self.logger.info(f'Slowest {len(slowest)} of {len(self.spans)} spans:')
+            for record in slowest:
+                labels = ', '.join(f'{field}={value}' for field, value in record.items() if field not in SPAN_FIELDS)
+                self.logger.info(f"{record['seconds']:9.2f} s  {record['span']}"
+                                 f"{f' ({labels})' if labels else ''}: {record['bytes'] / 1e6:.1f} MB, "
+                                 f"{record['api_calls']} API calls{'' if record['status'] == 'ok' else ', failed'}")
+        return slowest
+
+    def clear(self):
+        """
+        Forgets the spans kept in memory, e.g. between the runs of a long-running process; the metrics file is kept
+        """
+        with self.lock:
+            self.spans = []
+
+    def close(self):
+        """
+        Closes the metrics file
+        """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# recorder used by all modules; it keeps the spans in memory until a run installs one with a metrics file
+_recorder = MetricsRecorder()
+
+
+def get_metrics():
+    """
+    Returns the recorder of the current run
+    """
+    return _recorder
+
+
+def set_metrics(recorder):
+    """
+    Installs the recorder all modules report their spans to
+
+    Parameters
+    ----------
+    recorder : MetricsRecorder
+        Recorder of the current run.
+    """
+    global _recorder
+    _recorder = recorder
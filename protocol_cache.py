@@ -0,0 +1,154 @@
+import os
+import glob
+import hashlib
+import pandas as pd
+
+try:
+    import pyarrow  # optional; enables the columnar feather snapshot
+    SNAPSHOT_EXTENSION = 'feather'
+except ImportError:
+    SNAPSHOT_EXTENSION = 'pkl'
+
+# bump whenever the selected columns or their normalisation change
+SNAPSHOT_VERSION = 2
+
+# columns of Sheet2 that are used for the protocols, besides the Subject_<dept> columns
+TEXT_COLUMNS = ['Semester', 'Examiner', 'Summary', 'Atmosphere']
+
+# columns with few distinct values, besides the Subject_<dept> columns; they are stored as categoricals, so every
+# distinct value is kept once instead of once per response
+CATEGORY_COLUMNS = ['Semester', 'Examiner']
+
+
+def is_needed_column(column):
+    """
+    Selects the columns of the protocols sheet that are needed to generate the protocols
+
+    Parameters
+    ----------
+    column : str
+        Column name.
+
+    Returns
+    -------
+    needed : bool
+        True, if the column is a Subject_<dept> column or one of TEXT_COLUMNS.
+    """
+    return str(column).startswith('Subject_') or column in TEXT_COLUMNS
+
+
+def file_hash(file_path, block_size=1024 * 1024):
+    """
+    SHA-256 hash of a file
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the file.
+    block_size : int
+        Number of bytes read at once.
+
+    Returns
+    -------
+    file_hash : str
+        SHA-256 hex digest of the file content.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_snapshot(snapshot_path):
+    """
+    Reads a snapshot written by write_snapshot
+
+    Parameters
+    ----------
+    snapshot_path : str
+        Path to the snapshot.
+
+    Returns
+    -------
+    data : pandas dataframe
+        Dataframe stored in the snapshot.
+    """
+    if snapshot_path.endswith('.feather'):
+        return pd.read_feather(snapshot_path)
+    return pd.read_pickle(snapshot_path)
+
+
+def write_snapshot(data, snapshot_path):
+    """
+    Writes a dataframe to a snapshot; the file is replaced atomically
+
+    Parameters
+    ----------
+    data : pandas dataframe
+        Dataframe to store.
+    snapshot_path : str
+        Path to the snapshot.
+    """
+    tmp_path = f'{snapshot_path}.tmp'
+    if snapshot_path.endswith('.feather'):
+        data.to_feather(tmp_path)
+    else:
+        data.to_pickle(tmp_path)
+    os.replace(tmp_path, snapshot_path)
+
+
+def load_protocols(logger, path, filename, cache_folder='.cache'):
+    """
+    Loads the needed columns of the protocols sheet. The parsed sheet is stored as a snapshot keyed by the hash
+    of the spreadsheet, so later runs on the same spreadsheet skip the slow XLSX parsing.
+
+    Parameters
+    ----------
+    logger : logger object
+        logger object from the logging module.
+    path : str
+        Path to the folder containing the spreadsheet.
+    filename : str
+        Name of the file containing the protocols.
+    cache_folder : str
+        Name of the folder in path where the snapshots are stored.
+
+    Returns
+    -------
+    data : pandas dataframe
+        Dataframe with the Subject_<dept> and TEXT_COLUMNS columns. The Subject_<dept> and CATEGORY_COLUMNS
+        columns are categoricals with NaN for missing values, missing values of the other columns are None.
+    """
+    spreadsheet_path = os.path.join(path, filename)
+    cache_path = os.path.join(path, cache_folder)
+    digest = hashlib.sha256(f'{SNAPSHOT_VERSION}\n{file_hash(spreadsheet_path)}'.encode('utf-8')).hexdigest()
+    snapshot_path = os.path.join(cache_path, f'protocols_{digest[:16]}.{SNAPSHOT_EXTENSION}')
+
+    if os.path.isfile(snapshot_path):
+        try:
+            data = read_snapshot(snapshot_path)
+            logger.info(f'Loaded protocols from snapshot {snapshot_path}')
+            return data
+        except Exception as e:
+            logger.error(f'Could not read snapshot {snapshot_path}. Reason: {e}')
+
+    data = pd.read_excel(spreadsheet_path, sheet_name='Sheet2', engine='openpyxl', usecols=is_needed_column)
+
+    # store everything as text; a missing value is None whether it was parsed or read from a snapshot
+    data = data.astype(object).where(data.notna(), None)
+    data = data.apply(lambda column: column.map(lambda value: value if value is None else str(value)))
+    for column in data.columns:
+        if str(column).startswith('Subject_') or column in CATEGORY_COLUMNS:
+            data[column] = data[column].astype('category')
+
+    if not os.path.isdir(cache_path):
+        os.mkdir(cache_path)
+    for old_snapshot in glob.glob(os.path.join(cache_path, 'protocols_*')):
+        os.remove(old_snapshot)
+    try:
+        write_snapshot(data, snapshot_path)
+        logger.info(f'Stored protocols snapshot {snapshot_path}')
+    except Exception as e:
+        logger.error(f'Could not write snapshot {snapshot_path}. Reason: {e}')
+    return data
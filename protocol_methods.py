@@ -1,9 +1,35 @@
 import os
+import re
+import glob
+import fnmatch
 import shutil
+import hashlib
 import logging
+import tempfile
+import subprocess
+import pandas as pd
 from datetime import datetime
 from pylatex.utils import NoEscape, bold
 from pylatex import Document, Command, LargeText, MediumText, LineBreak, NewPage
+from pylatex.errors import CompilerError
+
+# characters pdflatex cannot typeset: astral-plane characters (most emojis), lone surrogates, emoji symbol blocks,
+# variation selectors and joiners, and control characters other than tab and newline
+UNSUPPORTED_CHARS = re.compile('[\U00010000-\U0010FFFF\ud800-\udfff\u2600-\u27bf\u2b00-\u2bff'
+                               '\u200d\u20e3\ufe0e\ufe0f\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+# semester names like "Fall 2023", "Spring 2024", "HS23" or "FS 2024"
+SEMESTER_PATTERN = re.compile(r'(spring|fs|fall|autumn|hs)\s*(\d{4}|\d{2})\b', re.IGNORECASE)
+SPRING_TERMS = ('spring', 'fs')
+
+# LaTeX math in a summary: $$...$$, $...$ or \(...\)
+MATH_SEGMENT = re.compile(r'\$\$.+?\$\$|\$.+?\$|\\\(.+?\\\)', re.DOTALL)
+
+# RAM-backed tmpfs on Linux; the protocols are compiled there if it is available
+SHARED_MEMORY_PATH = '/dev/shm'
+
+# creation date written into every PDF; a fixed date makes a rebuild of an unchanged protocol byte-identical
+PDF_SOURCE_DATE_EPOCH = '0'
 
 
 def clean_data_local(logger, folder_path):
@@ -20,9 +46,40 @@ def clean_data_local(logger, folder_path):
         logger.info(f"Deleted {file}")
     logger.info(f"Cleaned local folder {folder_path} ")
 
+def scratch_directory():
+    """
+    Directory for the temporary files of the compilation
+
+    Returns
+    -------
+    scratch_path : str
+        SHARED_MEMORY_PATH if it exists and is writable, otherwise the default temporary directory.
+    """
+    if os.path.isdir(SHARED_MEMORY_PATH) and os.access(SHARED_MEMORY_PATH, os.W_OK | os.X_OK):
+        return SHARED_MEMORY_PATH
+    return tempfile.gettempdir()
+
+
+def install_file(source_path, target_path):
+    """
+    Copies a file into place atomically: it is written next to the target under a temporary name and then renamed,
+    so nobody, e.g. the upload of the protocols, ever reads a partially written file
+
+    Parameters
+    ----------
+    source_path : str
+        Path to the file to copy, e.g. in a scratch directory on another filesystem.
+    target_path : str
+        Path the file is copied to; an existing file is replaced.
+    """
+    tmp_path = f'{target_path}.part'
+    shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+
+
 def filter_string(text):
     """
-    Filters a given string with respect to the UTF-8 charset. Removes emojis etc. that cannot be compiled with LaTeX
+    Filters a given string. Removes emojis etc. that cannot be compiled with LaTeX
 
     Parameters
     ----------
@@ -32,23 +89,85 @@ def filter_string(text):
     Returns
     -------
     filtered_text : str
-        Filtered string according to UTF-8.
+        Filtered string, "-" if text is not a string.
     latex : bool
         True, if the string contains LaTeX code.
     """
-    latex = False
-    if text.count("$") > 0 and text.count("$") % 2 == 0:
-        latex = True
     if not isinstance(text, str):
-        return "-"
-    filtered_text = ""
-    for char in text:
-        try:
-            char.encode('utf-8')
-            filtered_text += char
-        except ValueError:
-            pass
-    return filtered_text, latex
+        return "-", False
+    latex = MATH_SEGMENT.search(text) is not None
+    return UNSUPPORTED_CHARS.sub('', text), latex
+
+
+def semester_key(semester):
+    """
+    Parses a semester name into a sortable number
+
+    Parameters
+    ----------
+    semester : str
+        Semester name, e.g. "Fall 2023".
+
+    Returns
+    -------
+    key : int
+        2 * year for spring and 2 * year + 1 for fall semesters, so later semesters have larger keys;
+        -1 if the semester cannot be parsed.
+    """
+    match = SEMESTER_PATTERN.search(semester) if isinstance(semester, str) else None
+    if match is None:
+        return -1
+    term, year = match.group(1).lower(), int(match.group(2))
+    if year < 100:
+        year += 2000
+    return 2 * year + (0 if term in SPRING_TERMS else 1)
+
+
+def sanitize_columns(data, columns=('Summary', 'Atmosphere')):
+    """
+    Filters whole text columns at once, like filter_string does for a single string
+
+    Parameters
+    ----------
+    data : pandas dataframe
+        Dataframe containing the text columns.
+    columns : tuple
+        Names of the columns that should be filtered.
+
+    Returns
+    -------
+    sanitized : pandas dataframe
+        Dataframe with the same index as data and, for every column, the filtered text in <column>_text (None if
+        the cell is not a string) and whether it contains LaTeX code in <column>_latex.
+    """
+    sanitized = pd.DataFrame(index=data.index)
+    for column in columns:
+        is_text = data[column].map(lambda value: isinstance(value, str)).astype(bool)
+        text = data[column].where(is_text).astype(object).str.replace(UNSUPPORTED_CHARS, '', regex=True)
+        sanitized[f'{column}_text'] = text.where(is_text, None)
+        sanitized[f'{column}_latex'] = text.str.contains(MATH_SEGMENT, na=False).astype(bool)
+    return sanitized
+
+
+def matches_any(name, patterns):
+    """
+    Checks a name against shell-style patterns such as "Analysis*", ignoring the case. A pattern equal to the name
+    always matches, so names containing wildcard characters, e.g. "Physics [Lab]", can be selected as they are.
+
+    Parameters
+    ----------
+    name : str
+        Name to check, e.g. a subject or semester.
+    patterns : list
+        Patterns with the wildcards *, ? and [...].
+
+    Returns
+    -------
+    match : bool
+        True, if the name matches at least one of the patterns.
+    """
+    name = name.lower()
+    return any(name == pattern.lower() or fnmatch.fnmatchcase(name, pattern.lower()) for pattern in patterns)
 
 
 def filter_text(input_text):
@@ -61,6 +180,37 @@ def filter_text(input_text):
         filter_string(input_text)
 
 
+def tokenize_tex(text):
+    """
+    Splits a summary into text and LaTeX math segments in a single pass
+
+    Parameters
+    ----------
+    text : str
+        String that should be split.
+
+    Returns
+    -------
+    segments : list
+        (is_math, segment) pairs in the order of the text. A $ without a closing partner stays part of the text.
+    """
+    segments = []
+    position = 0
+    for match in MATH_SEGMENT.finditer(text):
+        if match.start() > position:
+            segments.append((False, text[position:match.start()]))
+        math, position = match.group(), match.end()
+
+        # add space in the same line of the mathmode, if eq is followed by space
+        if text.startswith(' ', position):
+            math += ' '
+            position += 1
+        segments.append((True, math))
+    if position < len(text):
+        segments.append((False, text[position:]))
+    return segments
+
+
 def split_tex(doc, text):
     """
     Takes a summary and splits it in a way that only the latex parts will be included with the NoEscape command
@@ -72,25 +222,8 @@ def split_tex(doc, text):
     text : str
         String that should be split and added to the document
     """
-    current_interval = ""
-    dollar_count = 0
-
-    for i, char in enumerate(text):
-        if char == '$':
-            dollar_count += 1
-            if dollar_count % 2 == 1:  # One occurrence of '$'
-                doc.append(current_interval)
-                current_interval = "$"
-            else:
-                current_interval += "$"
-                if i < len(text):
-                    if text[i + 1] == " ":      # add space in the same line of the mathmode, if eq is followed by space
-                        current_interval += " "
-                doc.append(NoEscape(current_interval))
-                current_interval = ""
-        else:
-            current_interval += char
-    doc.append(current_interval)  # append final text interval after last $
+    for is_math, segment in tokenize_tex(text):
+        doc.append(NoEscape(segment) if is_math else segment)
 
 
 def create_tex_preamble():
@@ -130,4 +263,90 @@ def create_tex_preamble():
         r'before upper={\begin{justify}\parindent0pt}, after upper={\end{justify}},}')
     )
     doc.preamble.append(NoEscape(r'\AddToShipoutPictureBG{\Watermark}'))
-    return doc
\ No newline at end of file
+
+    # Drop the trailer ID derived from time and filename, so an unchanged protocol compiles to the same bytes and
+    # keeps its md5Checksum; it goes into the body because the preamble format does not keep it
+    doc.append(NoEscape(r'\pdftrailerid{}'))
+    return doc
+
+
+def build_preamble_format(logger, cache_path, compiler='pdflatex'):
+    """
+    Dumps the preamble from create_tex_preamble into a precompiled format file with mylatexformat, so the packages
+    are loaded once instead of once per protocol. The format is named after a hash of the preamble and the compiler
+    version and is reused across runs until one of them changes.
+
+    Parameters
+    ----------
+    logger : logger object
+        logger object from the logging module.
+    cache_path : str
+        Path to the folder where the format file is stored.
+    compiler : str
+        LaTeX compiler the format is built for.
+
+    Returns
+    -------
+    fmt_name : str or None
+        Name of the format file without extension, or None if it could not be built.
+    """
+    preamble = create_tex_preamble().dumps().split(r'\begin{document}')[0]
+    try:
+        version = subprocess.run([compiler, '--version'], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error(f'Could not run {compiler}. Reason: {e}')
+        return None
+    digest = hashlib.sha256(f'{version.splitlines()[0]}\n{preamble}'.encode('utf-8')).hexdigest()
+    fmt_name = f'protocol_preamble_{digest[:16]}'
+    if os.path.isfile(os.path.join(cache_path, f'{fmt_name}.fmt')):
+        return fmt_name
+
+    # the preamble changed or the compiler was updated; remove outdated formats
+    if not os.path.isdir(cache_path):
+        os.mkdir(cache_path)
+    for old_file in glob.glob(os.path.join(cache_path, 'protocol_preamble_*')):
+        os.remove(old_file)
+
+    with open(os.path.join(cache_path, f'{fmt_name}.tex'), 'w', encoding='utf-8') as tex_file:
+        tex_file.write(preamble + '\\begin{document}\n\\end{document}\n')
+    try:
+        subprocess.run([compiler, '-ini', f'-jobname={fmt_name}', '-interaction=nonstopmode',
+                        f'&{compiler}', 'mylatexformat.ltx', f'{fmt_name}.tex'],
+                       cwd=cache_path, capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error(f'Could not build the preamble format. Reason: {e}')
+        return None
+    logger.info(f'Built preamble format {fmt_name}.')
+    return fmt_name
+
+
+def compile_tex(build_dir, basename, compiler='pdflatex', fmt_name=None):
+    """
+    Compiles a tex file to PDF inside its working directory
+
+    Parameters
+    ----------
+    build_dir : str
+        Path to the working directory containing <basename>.tex.
+    basename : str
+        Filename of the tex file without extension.
+    compiler : str
+        LaTeX compiler to use.
+    fmt_name : str, optional
+        Name of a precompiled format in build_dir, see build_preamble_format.
+
+    Raises
+    ------
+    CompilerError
+        If the compiler reports an error; the message contains the error lines of the log.
+    """
+    command = [compiler, '--interaction=nonstopmode', f'{basename}.tex']
+    if fmt_name is not None:
+        command.insert(1, f'-fmt={fmt_name}')
+    # fixed creation and modification dates, see PDF_SOURCE_DATE_EPOCH
+    env = {**os.environ, 'SOURCE_DATE_EPOCH': PDF_SOURCE_DATE_EPOCH, 'FORCE_SOURCE_DATE': '1'}
+    try:
+        subprocess.run(command, cwd=build_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+    except subprocess.CalledProcessError as e:
+        errors = [line for line in e.output.decode('utf-8', errors='replace').splitlines() if line.startswith('!')]
+        raise CompilerError(f'{compiler} failed on {basename}.tex: {" ".join(errors[:3]) or e}')
@@ -0,0 +1,467 @@
+from __future__ import print_function
+
+import os
+import json
+import time
+import random
+import shutil
+import hashlib
+import itertools
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+
+from googleapiclient.errors import HttpError
+from drive_api_session import get_drive_session
+from drive_api_folder import resolve_folder, list_folder_files, delete_files, FOLDER_MIMETYPE
+from drive_api_upload import upload_resumable
+from drive_api_changes import get_start_page_token, list_changes
+from drive_api_sync import md5_checksum
+from drive_api_retry import get_request_executor
+from metrics import get_metrics
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def http_error(status, reason, message):
+    """
+    Builds the HttpError the Drive API raises for a failed request, so offline backends fail the same way
+
+    Parameters
+    ----------
+    status : int
+        HTTP status code.
+    reason : str
+        Reason of the error, e.g. 'rateLimitExceeded' or 'notFound'.
+    message : str
+        Human readable error message.
+
+    Returns
+    -------
+    error : HttpError
+        Error with the status code and a JSON body like the one of the Drive API.
+    """
+    from httplib2 import Response
+
+    content = json.dumps({'error': {'code': status, 'message': message,
+                                    'errors': [{'domain': 'usageLimits', 'reason': reason, 'message': message}]}})
+    return HttpError(Response({'status': status}), content.encode('utf-8'))
+
+
+class StorageBackend(ABC):
+    """
+    Storage the protocols spreadsheet is exported from and the PDF protocols are uploaded to. Folders are
+    identified by lists of IDs as returned by find_folder, files by the dicts returned by list_folder with the
+    keys 'id', 'name' and 'md5Checksum'. Failed requests raise HttpError like the Drive API does.
+    """
+    @abstractmethod
+    def metadata(self, file_id):
+        """
+        Returns the modifiedTime and version of a file, used to detect whether the spreadsheet changed
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def export(self, file_id, file_path):
+        """
+        Exports the spreadsheet with the given ID in XLSX format to file_path
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_folder(self, folder_name, parent_folder_id=None):
+        """
+        Returns the IDs of the folders with the given name
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_folder(self, folder_id):
+        """
+        Returns all files in a folder as dicts with the keys 'id', 'name' and 'md5Checksum'
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, files):
+        """
+        Deletes files as returned by list_folder and returns the ones that could not be deleted
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def upload(self, filepath, filename, parents, file_id=None):
+        """
+        Uploads a local file into the folder parents, replacing the content of file_id if given, and returns its ID
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rename(self, file_id, filename):
+        """
+        Renames a file without touching its content
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def start_page_token(self):
+        """
+        Returns the token of the current position of the changes feed
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def changes(self, page_token):
+        """
+        Returns the IDs of the files changed since page_token and the token to continue from
+        """
+        raise NotImplementedError
+
+
+class DriveBackend(StorageBackend):
+    """
+    Google Drive, accessed with the drive_api_* functions
+    """
+    def __init__(self, logger, token_path):
+        """
+        Initialize DriveBackend class
+
+        Parameters
+        ----------
+        logger : logger object
+            logger object from the logging module.
+        token_path : str
+            Path to the folder containing the token.json file.
+        """
+        self.logger = logger
+        self.token_path = token_path
+
+    def metadata(self, file_id):
+        service = get_drive_session(self.token_path).service
+        # pylint: disable=maybe-no-member
+        metadata = get_request_executor().execute(service.files().get(fileId=file_id,
+                                                                      fields='modifiedTime, version').execute)
+        get_metrics().count(api_calls=1)
+        return metadata
+
+    def export(self, file_id, file_path):
+        from googleapiclient.http import MediaIoBaseDownload
+
+        service = get_drive_session(self.token_path).service
+        request = service.files().export_media(fileId=file_id, mimeType=XLSX_MIMETYPE)
+        with open(file_path, 'wb') as output_file:
+            downloader = MediaIoBaseDownload(output_file, request)
+            done = False
+            while done is False:
+                status, done = get_request_executor().execute(downloader.next_chunk)
+                get_metrics().count(api_calls=1)
+                self.logger.info(F'Download {int(status.progress() * 100)}.')
+
+    def find_folder(self, folder_name, parent_folder_id=None):
+        return resolve_folder(self.logger, self.token_path, folder_name, parent_folder_id=parent_folder_id)
+
+    def list_folder(self, folder_id):
+        return list_folder_files(self.logger, self.token_path, folder_id)
+
+    def delete(self, files):
+        return delete_files(self.logger, self.token_path, files)
+
+    def upload(self, filepath, filename, parents, file_id=None):
+        return upload_resumable(self.logger, self.token_path, filepath, filename, parents, file_id=file_id)
+
+    def rename(self, file_id, filename):
+        service = get_drive_session(self.token_path).service
+        get_request_executor().execute(service.files().update(fileId=file_id, body={'name': filename},
+                                                              fields='id').execute)
+        get_metrics().count(api_calls=1)
+
+    def start_page_token(self):
+        return get_start_page_token(self.logger, self.token_path)
+
+    def changes(self, page_token):
+        return list_changes(self.logger, self.token_path, page_token)
+
+
+class LocalBackend(StorageBackend):
+    """
+    Directory on the local filesystem standing in for the shared drive. Folders are subdirectories of root and
+    IDs are paths relative to root; missing folders are created by find_folder. The spreadsheet ID is the
+    relative path of an XLSX file, which is copied on export. The changes feed reports the files whose
+    modification time is later than the page token; deleted files are not reported.
+    """
+    def __init__(self, logger, root):
+        """
+        Initialize LocalBackend class
+
+        Parameters
+        ----------
+        logger : logger object
+            logger object from the logging module.
+        root : str
+            Path to the directory standing in for the shared drive.
+        """
+        self.logger = logger
+        self.root = root
+
+    def path(self, file_id):
+        return os.path.join(self.root, file_id)
+
+    def metadata(self, file_id):
+        stat = os.stat(self.path(file_id))
+        return {'modifiedTime': datetime.fromtimestamp(stat.st_mtime, timezone.utc).isoformat(),
+                'version': str(stat.st_mtime_ns)}
+
+    def export(self, file_id, file_path):
+        shutil.copyfile(self.path(file_id), file_path)
+
+    def find_folder(self, folder_name, parent_folder_id=None):
+        folder_id = os.path.join(parent_folder_id or '', folder_name)
+        if not os.path.isdir(self.path(folder_id)):
+            os.makedirs(self.path(folder_id))
+            self.logger.info(f'Created local storage folder {self.path(folder_id)}')
+        return [folder_id]
+
+    def list_folder(self, folder_id):
+        files = []
+        for filename in sorted(os.listdir(self.path(folder_id[0]))):
+            file_id = os.path.join(folder_id[0], filename)
+            if os.path.isfile(self.path(file_id)):
+                files.append({'id': file_id, 'name': filename, 'md5Checksum': md5_checksum(self.path(file_id))})
+        self.logger.info(f'Listed {len(files)} remote files.')
+        return files
+
+    def delete(self, files):
+        failed = []
+        for file in files:
+            try:
+                os.remove(self.path(file['id']))
+                self.logger.info(f"Deleted {file['name']}.")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.error(f"Could not delete {file['name']}. Reason: {e}")
+                failed.append(file)
+        return failed
+
+    def upload(self, filepath, filename, parents, file_id=None):
+        new_id = os.path.join(parents[0], filename)
+        tmp_path = f'{self.path(new_id)}.part'
+        shutil.copyfile(os.path.join(filepath, filename), tmp_path)
+        os.replace(tmp_path, self.path(new_id))
+        if file_id is not None and file_id != new_id and os.path.isfile(self.path(file_id)):
+            os.remove(self.path(file_id))
+        get_metrics().count(bytes=os.path.getsize(self.path(new_id)))
+        return new_id
+
+    def rename(self, file_id, filename):
+        os.replace(self.path(file_id), self.path(os.path.join(os.path.dirname(file_id), filename)))
+
+    def modification_times(self):
+        """
+        Modification times in nanoseconds of all files below root, keyed by their IDs
+        """
+        times = {}
+        for folder, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                file_path = os.path.join(folder, filename)
+                try:
+                    times[os.path.relpath(file_path, self.root)] = os.stat(file_path).st_mtime_ns
+                except FileNotFoundError:
+                    pass
+        return times
+
+    def start_page_token(self):
+        return str(max(self.modification_times().values(), default=0))
+
+    def changes(self, page_token):
+        changed = sorted((mtime, file_id) for file_id, mtime in self.modification_times().items()
+                         if mtime > int(page_token))
+        return [file_id for _, file_id in changed], str(max([int(page_token)] + [mtime for mtime, _ in changed]))
+
+
+class MemoryBackend(StorageBackend):
+    """
+    In-memory stand-in for the shared drive that can simulate the latency and the quota errors of the Drive API.
+    Every request waits for latency seconds; it fails with a 429 error with probability quota_error_rate, and
+    with a 403 error if more than calls_per_second requests were made within the last second. Like the Drive
+    requests, the simulated requests are made with the shared request executor. Every change of a file is
+    appended to a log that serves as the changes feed; its page tokens are positions in the log.
+    """
+    def __init__(self, logger=None, latency=0.0, quota_error_rate=0.0, calls_per_second=None, seed=None):
+        """
+        Initialize MemoryBackend class
+
+        Parameters
+        ----------
+        logger : logger object, optional
+            logger object from the logging module.
+        latency : float
+            Seconds every request takes.
+        quota_error_rate : float
+            Probability that a request fails with 429 rateLimitExceeded.
+        calls_per_second : int, optional
+            Number of requests per second above which requests fail with 403 userRateLimitExceeded.
+        seed : int, optional
+            Seed of the random number generator deciding which requests fail.
+        """
+        self.logger = logger
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.calls_per_second = calls_per_second
+        self.rng = random.Random(seed)
+        self.files = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.calls = []
+        self.change_log = []
+        self.stats = {'calls': 0, 'quota_errors': 0, 'upload_bytes': 0}
+
+    def call(self):
+        """
+        Makes one simulated request with the shared request executor, which retries the quota errors
+        """
+        get_request_executor().execute(self.request)
+
+    def request(self):
+        """
+        Simulates one API request: waits for the latency and raises the quota errors
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        get_metrics().count(api_calls=1)
+        with self.lock:
+            now = time.monotonic()
+            self.stats['calls'] += 1
+            self.calls = [call for call in self.calls if now - call < 1.0] + [now]
+            if self.calls_per_second is not None and len(self.calls) > self.calls_per_second:
+                self.stats['quota_errors'] += 1
+                raise http_error(403, 'userRateLimitExceeded', 'User Rate Limit Exceeded')
+            if self.rng.random() < self.quota_error_rate:
+                self.stats['quota_errors'] += 1
+                raise http_error(429, 'rateLimitExceeded', 'Rate Limit Exceeded')
+
+    def add_file(self, name, content, parents=None, mimeType=None):
+        """
+        Stores a file without simulating a request, e.g. the spreadsheet before a run
+
+        Parameters
+        ----------
+        name : str
+            Name of the file.
+        content : bytes
+            Content of the file.
+        parents : list, optional
+            IDs of the parent folders.
+        mimeType : str, optional
+            MIME type of the file.
+
+        Returns
+        -------
+        file_id : str
+            ID of the new file.
+        """
+        with self.lock:
+            file_id = f'memory{next(self.ids)}'
+            self.files[file_id] = {'name': name, 'parents': list(parents or []), 'mimeType': mimeType,
+                                   'content': content, 'md5Checksum': hashlib.md5(content).hexdigest(),
+                                   'modifiedTime': datetime.now(timezone.utc).isoformat(), 'version': 1}
+            self.change_log.append(file_id)
+        return file_id
+
+    def update_file(self, file_id, content):
+        """
+        Replaces the content of a file without simulating a request, e.g. a new response in the spreadsheet
+
+        Parameters
+        ----------
+        file_id : str
+            ID of the file.
+        content : bytes
+            New content of the file.
+        """
+        file = self.get(file_id)
+        with self.lock:
+            file.update(content=content, md5Checksum=hashlib.md5(content).hexdigest(),
+                        modifiedTime=datetime.now(timezone.utc).isoformat(), version=file['version'] + 1)
+            self.change_log.append(file_id)
+
+    def get(self, file_id):
+        with self.lock:
+            file = self.files.get(file_id)
+        if file is None:
+            raise http_error(404, 'notFound', f'File not found: {file_id}.')
+        return file
+
+    def metadata(self, file_id):
+        self.call()
+        file = self.get(file_id)
+        return {'modifiedTime': file['modifiedTime'], 'version': str(file['version'])}
+
+    def export(self, file_id, file_path):
+        self.call()
+        with open(file_path, 'wb') as output_file:
+            output_file.write(self.get(file_id)['content'])
+
+    def find_folder(self, folder_name, parent_folder_id=None):
+        self.call()
+        with self.lock:
+            folder_id = [file_id for file_id, file in self.files.items()
+                         if file['mimeType'] == FOLDER_MIMETYPE and file['name'] == folder_name
+                         and (parent_folder_id is None or parent_folder_id in file['parents'])]
+        if not folder_id:
+            folder_id = [self.add_file(folder_name, b'', [parent_folder_id] if parent_folder_id else None,
+                                       mimeType=FOLDER_MIMETYPE)]
+        return folder_id
+
+    def list_folder(self, folder_id):
+        self.call()
+        with self.lock:
+            return [{'id': file_id, 'name': file['name'], 'md5Checksum': file['md5Checksum']}
+                    for file_id, file in self.files.items() if folder_id[0] in file['parents']]
+
+    def delete(self, files):
+        failed = []
+        for file in files:
+            try:
+                self.call()
+                with self.lock:
+                    if self.files.pop(file['id'], None) is not None:
+                        self.change_log.append(file['id'])
+            except HttpError as error:
+                if self.logger is not None:
+                    self.logger.error(f"Could not delete {file['name']}. Reason: {error}")
+                failed.append(file)
+        return failed
+
+    def upload(self, filepath, filename, parents, file_id=None):
+        with open(os.path.join(filepath, filename), 'rb') as file:
+            content = file.read()
+        self.call()
+        get_metrics().count(bytes=len(content))
+        with self.lock:
+            self.stats['upload_bytes'] += len(content)
+        if file_id is None:
+            return self.add_file(filename, content, parents)
+        file = self.get(file_id)
+        with self.lock:
+            file.update(name=filename, content=content, md5Checksum=hashlib.md5(content).hexdigest(),
+                        modifiedTime=datetime.now(timezone.utc).isoformat(), version=file['version'] + 1)
+            self.change_log.append(file_id)
+        return file_id
+
+    def rename(self, file_id, filename):
+        self.call()
+        file = self.get(file_id)
+        with self.lock:
+            file['name'] = filename
+            self.change_log.append(file_id)
+
+    def start_page_token(self):
+        self.call()
+        with self.lock:
+            return str(len(self.change_log))
+
+    def changes(self, page_token):
+        self.call()
+        with self.lock:
+            return self.change_log[int(page_token):], str(len(self.change_log))
@@ -0,0 +1,67 @@
+from functools import lru_cache
+from pylatex.base_classes import LatexObject
+from pylatex.utils import NoEscape, escape_latex
+from protocol_methods import create_tex_preamble
+
+# placeholder content used to split a dumped document into the part before and after its content
+CONTENT_MARKER = 'EXAMBOT-CONTENT-MARKER'
+
+
+@lru_cache(maxsize=None)
+def document_frame():
+    """
+    The LaTeX code surrounding the content of a protocol, as pylatex dumps it
+
+    Returns
+    -------
+    head : str
+        Document class, preamble and begin of the document, up to the first content item.
+    tail : str
+        End of the document after the last content item.
+    """
+    doc = create_tex_preamble()
+    doc.append(NoEscape(CONTENT_MARKER))
+    head, tail = doc.dumps().split(CONTENT_MARKER)
+    return head, tail[len(doc.content_separator):]
+
+
+class TexStreamWriter:
+    """
+    Writes a protocol straight to a file instead of building a pylatex document tree first. It accepts the same
+    items as pylatex.Document.append and produces the same LaTeX code with the same escaping rules.
+    """
+    def __init__(self, file):
+        """
+        Writes the preamble to the file
+
+        Parameters
+        ----------
+        file : file object
+            Text file the protocol is written to.
+        """
+        self.file = file
+        self.separator = create_tex_preamble().content_separator
+        head, self.tail = document_frame()
+        self.file.write(head)
+
+    def append(self, item):
+        """
+        Writes one content item
+
+        Parameters
+        ----------
+        item : str or pylatex object
+            Strings are escaped unless they are NoEscape; pylatex objects are dumped.
+        """
+        if isinstance(item, LatexObject):
+            tex = item.dumps_as_content()
+        else:
+            tex = escape_latex(item if isinstance(item, str) else str(item))
+        self.file.write(tex)
+        self.file.write(self.separator)
+
+    def close(self):
+        """
+        Writes the end of the document
+        """
+        self.file.write(self.tail)